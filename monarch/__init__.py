@@ -3,7 +3,7 @@ import os
 import re
 import sys
 from importlib import import_module
-from six import iteritems
+from contextlib import contextmanager
 
 # 3rd Party Imports
 import click
@@ -15,23 +15,60 @@ echo = echo
 progressbar = progressbar
 
 # Local Imports
-from .models import Migration, QuerySet
-from .local import local_restore, local_backups, backup_localy
-from .s3 import get_s3_bucket, generate_uniqueish_key, backup_to_s3, s3_restore, s3_backups
-from .migrations import generate_migration_name, create_package_if_necessary, find_migrations
+# Only what every command needs is imported here.  The backends -- pymongo, mongoengine, boto and the modules built on
+# them -- are imported by the commands that use them, so `monarch --help` or `monarch generate` start quickly.
+from .migrations import generate_migration_name, create_package_if_necessary, find_migrations, migration_graph, \
+    run_migration_graph
 from .query_sets import querysets, generate_queryset_name
-
-from .mongo import MongoMigrationHistory, MongoBackedMigration, \
-    establish_datastore_connection, \
-    restore as restore_mongo_db, \
-    copy_db as copy_mongo_db, \
-    drop as drop_mongo_db
-
 from .utils import temp_directory, camel_to_underscore, \
     underscore_to_camel, sizeof_fmt, exit_with_message
 
 from .templates import MIGRATION_TEMPLATE, CONFIG_TEMPLATE, QUERYSET_TEMPLATE
 
+# public names that migrations and query sets import from monarch, i.e. `from monarch import MongoBackedMigration`
+# name: module, or (module, name in the module) for the ones exposed under another name
+LAZY_ATTRIBUTES = {
+    'Migration': 'models',
+    'QuerySet': 'models',
+    'DumpFailed': 'models',
+    'MongoMigrationHistory': 'mongo',
+    'MongoMigrationHistoryCache': 'mongo',
+    'MongoBackedMigration': 'mongo',
+    'establish_datastore_connection': 'mongo',
+    'restore_mongo_db': ('mongo', 'restore'),
+    'copy_mongo_db': ('mongo', 'copy_db'),
+    'drop_mongo_db': ('mongo', 'drop'),
+    'local_restore': 'local',
+    'local_backups': 'local',
+    'backup_localy': 'local',
+    'get_s3_bucket': 's3',
+    'generate_uniqueish_key': 's3',
+    'backup_to_s3': 's3',
+    's3_restore': 's3',
+    's3_backups': 's3',
+}
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # PEP 562, only called for names not set on the module yet
+        if name not in LAZY_ATTRIBUTES:
+            raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+        module_name, attribute = LAZY_ATTRIBUTES[name], name
+        if isinstance(module_name, tuple):
+            module_name, attribute = module_name
+        value = getattr(import_module('.' + module_name, __name__), attribute)
+        globals()[name] = value
+        return value
+else:
+    from .models import Migration, QuerySet, DumpFailed
+    from .mongo import MongoMigrationHistory, MongoMigrationHistoryCache, MongoBackedMigration, \
+        establish_datastore_connection, \
+        restore as restore_mongo_db, \
+        copy_db as copy_mongo_db, \
+        drop as drop_mongo_db
+    from .local import local_restore, local_backups, backup_localy
+    from .s3 import get_s3_bucket, generate_uniqueish_key, backup_to_s3, s3_restore, s3_backups
+
 
 class Config(object):
 
@@ -140,25 +177,50 @@ def generate_query_set(config, name):
 
 @cli.command(name='list_migrations')
 @click.argument('environment')
+@click.option('--json', 'as_json', is_flag=True, default=False,
+              help='print the migrations, their status and what their last run cost as json')
 @pass_config
-def lizt(config, environment):
+def lizt(config, environment, as_json):
     """ Lists the migrations and the status against the specified environemnt
 
+    Along with when each ran last, how long it took (wall and CPU time), the peak memory of the process and the
+    number of documents it read and wrote.
     """
     if environment not in config.environments:
         exit_with_message("Environment not described in settings.py")
 
     migrations_on_file_system = find_migrations(config)
 
+    from .mongo import establish_datastore_connection, MongoMigrationHistoryCache
+    from .telemetry import telemetry_of
     establish_datastore_connection(config.environments[environment])
+    history = MongoMigrationHistoryCache()
+
+    if as_json:
+        import json
+        migrations = []
+        for migration_name in migrations_on_file_system:
+            migration_meta = history.find_by_key(migration_name)
+            entry = {'key': migration_name, 'state': migration_meta.state if migration_meta else None}
+            entry.update(telemetry_of(migration_meta))
+            migrations.append(entry)
+        echo(json.dumps(migrations, indent=2, sort_keys=True))
+        return
 
     if migrations_on_file_system:
         click.echo("Here are the migrations:")
-        echo("{:50} {}".format('MIGRATIONS', 'STATUS'))
+        row = "{:50} {:12} {:20} {:>9} {:>9} {:>10} {:>10} {:>10}"
+        echo(row.format('MIGRATIONS', 'STATUS', 'PROCESSED AT', 'WALL', 'CPU', 'PEAK RSS', 'READ', 'WRITTEN'))
         for migration_name in migrations_on_file_system:
-            migration_meta = MongoMigrationHistory.find_by_key(migration_name)
+            migration_meta = history.find_by_key(migration_name)
             if migration_meta:
-                echo("{:50} {}".format(migration_name, migration_meta.state))
+                echo(row.format(migration_name, migration_meta.state,
+                                _or_blank(migration_meta.processed_at, lambda at: at.strftime('%Y-%m-%d %H:%M:%S')),
+                                _or_blank(migration_meta.wall_seconds, '{:.1f}s'.format),
+                                _or_blank(migration_meta.cpu_seconds, '{:.1f}s'.format),
+                                _or_blank(migration_meta.peak_rss_bytes, sizeof_fmt),
+                                _or_blank(migration_meta.documents_read, str),
+                                _or_blank(migration_meta.documents_written, str)))
             else:
                 echo("{:50} NOT RUN".format(migration_name))
 
@@ -166,12 +228,31 @@ def lizt(config, environment):
         click.echo("No pending migrations")
 
 
+def _or_blank(value, formatter):
+    return '' if value is None else formatter(value)
+
+
 @cli.command()
 @click.argument('environment')
+@click.option('--workers', type=int, default=None,
+              help='how many independent migrations may run at once, defaults to migration_workers of the environment')
+@click.option('--resume/--no-resume', default=None,
+              help='resume migrations that stopped at a checkpoint, asks for each one by default')
+@click.option('--profile-queries', is_flag=True, default=False,
+              help='report the query shapes each migration sent, their count, time and plan (COLLSCAN, IXSCAN ...)')
 @pass_config
-def migrate(config, environment):
+def migrate(config, environment, workers, resume, profile_queries):
     """
     Runs all migrations that have yet to have run.
+
+    Migrations that declare the `collections` they touch run alongside the ones they share no collection with, up to
+    --workers at a time.  Anything declared in `depends_on`, or sharing a collection with an earlier migration, runs
+    after it.
+
+    Migrations that stopped after saving a checkpoint can resume from it, see --resume.
+
+    --profile-queries runs the migrations one at a time and reports the queries each of them sent, to find the
+    collection scans before they hit production.
     :return:
     """
     if environment not in config.environments:
@@ -183,12 +264,64 @@ def migrate(config, environment):
     # key = name, value = MigrationClass
     migrations = find_migrations(config)
     if migrations:
-        establish_datastore_connection(config.environments[environment])
-        for k, migration_class in iteritems(migrations):
-            migration_instance = migration_class()
+        from .mongo import establish_datastore_connection, MongoMigrationHistoryCache
+        from .models import Migration
+        from .throttle import throttle_for
+        profiler = start_query_profiler() if profile_queries else None
+        connection = establish_datastore_connection(config.environments[environment])
+        history = MongoMigrationHistoryCache()
+        throttle = throttle_for(config.environments[environment], connection, label='migrate')
+
+        # 2) Order them -- a migration waits for the ones it depends on or shares collections with
+        try:
+            graph = migration_graph(migrations)
+        except Exception as e:
+            exit_with_message(str(e))
+
+        # ask about resuming up front, the migrations may run on several threads
+        resume_decisions = {}
+        for migration_name in graph:
+            record = history.find_by_key(migration_name)
+            if resume is None and record is not None and record.checkpoint and \
+                    record.state in (Migration.STATE_PROCESSING, Migration.STATE_FAILED):
+                resume_decisions[migration_name] = click.confirm(
+                    "{} stopped ({}) at checkpoint {} -- resume from there?".format(
+                        migration_name, record.state, record.checkpoint))
+
+        def run(migration_name):
+            record = history.find_by_key(migration_name)
+            if record is not None and not Migration.would_run(
+                    record.state, record.checkpoint, resume_decisions.get(migration_name, resume)):
+                # nothing to do, leave its module unimported
+                if record.state == Migration.STATE_COMPLETED:
+                    echo("{} has already been processed".format(migration_name))
+                else:
+                    echo("{} is still {}, running the migrations after it anyway".format(migration_name, record.state))
+                return True
+
+            migration_instance = migrations[migration_name](history=history, throttle=throttle)
 
             # 3) Run the migration -- it will only run if it has not yet been run yet
-            migration_instance.process()
+            with profiled(profiler, connection, migration_name):
+                if not migration_instance.process(resume=resume_decisions.get(migration_name, resume)):
+                    # held by another runner, what waits on it has to wait for that runner
+                    return False
+            status = migration_instance.status
+            if status != Migration.STATE_COMPLETED:
+                # left as it was by an earlier run and not resumed, the migrations after it run as they always have
+                echo("{} is still {}, running the migrations after it anyway".format(migration_name, status))
+            return True
+
+        if workers is None:
+            workers = config.environments[environment].get('migration_workers', 1)
+        if profiler is not None and workers > 1:
+            echo("Profiling queries, running the migrations one at a time")
+            workers = 1
+        try:
+            run_migration_graph(graph, run, workers=workers)
+        finally:
+            if throttle is not None:
+                throttle.report()
     else:
         click.echo("No migrations exist")
 
@@ -197,10 +330,15 @@ def migrate(config, environment):
 @cli.command()
 @click.argument('migration_name')
 @click.argument('environment')
+@click.option('--resume/--no-resume', default=None,
+              help='pick up from the checkpoint of a migration that stopped, asks by default')
+@click.option('--profile-queries', is_flag=True, default=False,
+              help='report the query shapes the migration sent, their count, time and plan (COLLSCAN, IXSCAN ...)')
 @pass_config
-def migrate_one(config, migration_name, environment):
+def migrate_one(config, migration_name, environment, resume, profile_queries):
     """
-    Runs all migrations that have yet to have run.
+    Runs one migration, whatever its state.  If it stopped after saving a checkpoint it can resume from there
+    instead of starting over.
     :return:
     """
     if environment not in config.environments:
@@ -208,19 +346,44 @@ def migrate_one(config, migration_name, environment):
 
     check_for_hazardous_operations(config, environment)
 
-    establish_datastore_connection(config.environments[environment])
+    from .mongo import establish_datastore_connection
+    from .throttle import throttle_for
+    profiler = start_query_profiler() if profile_queries else None
+    connection = establish_datastore_connection(config.environments[environment])
+    throttle = throttle_for(config.environments[environment], connection, label='migrate')
 
     # 1) Find all migrations in the migrations/ directory
     # key = name, value = MigrationClass
-    migration = find_migration(config, migration_name)
-    migration.process(force=True)
+    migration = find_migration(config, migration_name, throttle=throttle)
+    try:
+        with profiled(profiler, connection, migration_name):
+            migration.process(force=True, resume=resume)
+    finally:
+        if throttle is not None:
+            throttle.report()
+
 
+def start_query_profiler():
+    """listens to the queries of every connection made from now on, see profiling.py"""
+    from .profiling import register_profiler
+    from .mongo import MongoMigrationHistory
+    return register_profiler(ignored_collections=[MongoMigrationHistory._get_collection_name()])
 
-def find_migration(config, migration_name):
+
+@contextmanager
+def profiled(profiler, client, migration_name):
+    if profiler is None:
+        yield
+        return
+    with profiler.profiling(client, migration_name):
+        yield
+
+
+def find_migration(config, migration_name, throttle=None):
 
     migrations = find_migrations(config)
     migration_class = migrations[migration_name]
-    return migration_class()
+    return migration_class(throttle=throttle)
 
 
 
@@ -254,9 +417,18 @@ def init(migration_directory):
 
 @cli.command()
 @click.option('--query-set', help='provide optional query-set filter, default is the entire db')
+@click.option('--stream', is_flag=True, default=False,
+              help='pipe the dump straight into the restore, without writing it to disk')
+@click.option('--skip-indexes', is_flag=True, default=False,
+              help='only restore the _id indexes, handy for throwaway dev copies')
+@click.option('--sample', help='copy only a sample of every collection, a percentage (1%) or a number of documents')
+@click.option('--sample-method', type=click.Choice(['random', 'range']), default='random',
+              help='random documents ($sample) or one _id range from a random start')
+@click.option('--keep-references', is_flag=True, default=False,
+              help='also copy what sampled documents refer to, through the relationships of the source environment')
 @click.argument('from_to')
 @pass_config
-def copy_db(config, from_to, query_set):
+def copy_db(config, from_to, query_set, stream, skip_indexes, sample, sample_method, keep_references):
     """ Copys a database and imports into another database
 
         Example
@@ -264,6 +436,10 @@ def copy_db(config, from_to, query_set):
         monarch import_db production:local
         monarch import_db staging:local
 
+        use --stream to restore while the dump is still running (full copies only)
+
+        use --sample 1% (or --sample 5000) for a representative slice of every collection
+
     """
     if ':' not in from_to:
         exit_with_message("Expecting from:to syntax like production:local")
@@ -281,20 +457,32 @@ def copy_db(config, from_to, query_set):
     if to_db not in config.environments:
         exit_with_message('Environments does not have a specification for {}'.format(to_db))
 
+    if stream and query_set:
+        exit_with_message('--stream copies the entire db, it can not be combined with --query-set')
+
+    if sample and (stream or query_set):
+        exit_with_message('--sample can not be combined with --stream or --query-set')
+
     query_set_class = None
     if query_set:
-        if query_set not in querysets(config):
+        available_query_sets = querysets(config)
+        if query_set not in available_query_sets:
             exit_with_message('Could not find specified query_set in your queryset folder')
         else:
-            query_set_class = querysets(config)[query_set]
+            query_set_class = available_query_sets[query_set].load()
+    elif sample:
+        query_set_class = sampling_query_set(config.environments[from_db], sample, sample_method, keep_references)
 
     if click.confirm('Are you SURE you want to copy data from {} into {}?'.format(from_db, to_db)):
         echo()
         echo("Okay, you asked for it ...")
         echo()
+        from .mongo import copy_db as copy_mongo_db
         copy_mongo_db(config.environments[from_db],
                       config.environments[to_db],
-                      query_set_class)
+                      query_set_class,
+                      stream=stream,
+                      skip_indexes=skip_indexes)
 
 
 @cli.command()
@@ -306,6 +494,7 @@ def drop_db(config, environment):
 
     check_for_hazardous_operations(config, environment)
 
+    from .mongo import drop as drop_mongo_db
     drop_mongo_db(config.environments[environment])
 
 
@@ -313,14 +502,25 @@ def drop_db(config, environment):
 @click.argument('environment')
 @click.option('--name', help='name to prefix the backup with')
 @click.option('--query-set', help='provide optional query-set filter, default is the entire db')
+@click.option('--incremental', is_flag=True, default=False,
+              help='only back up what changed since the last backup of this environment')
+@click.option('--sample', help='back up only a sample of every collection, a percentage (1%) or a number of documents')
+@click.option('--sample-method', type=click.Choice(['random', 'range']), default='random',
+              help='random documents ($sample) or one _id range from a random start')
+@click.option('--keep-references', is_flag=True, default=False,
+              help='also back up what sampled documents refer to, through the relationships of the environment')
 @pass_config
-def backup(config, environment, name, query_set):
+def backup(config, environment, name, query_set, incremental, sample, sample_method, keep_references):
     """ Backs up a given datastore
         It is configured in the BACKUPS section of settings
         You can back up locally or to S3
 
         use --name if you want to specify a name, otherwise it will use your environment name
 
+        use --incremental to dump only the documents above the watermarks of the last backup
+
+        use --sample 1% (or --sample 5000) to back up a representative slice of every collection
+
     """
     env_name = environment
 
@@ -329,36 +529,109 @@ def backup(config, environment, name, query_set):
 
     environment = confirm_environment(config, env_name)
 
+    if incremental and query_set:
+        exit_with_message('--incremental backs up the entire db, it can not be combined with --query-set')
+
+    if sample and (incremental or query_set):
+        exit_with_message('--sample can not be combined with --incremental or --query-set')
+
     query_set_class = None
     if query_set:
-        if query_set not in querysets(config):
+        available_query_sets = querysets(config)
+        if query_set not in available_query_sets:
             exit_with_message('Could not find specified query_set in your queryset folder')
         else:
-            query_set_class = querysets(config)[query_set]
+            query_set_class = available_query_sets[query_set].load()
+
+    catalog_fields = {}
+    if sample:
+        query_set_class = sampling_query_set(environment, sample, sample_method, keep_references)
+        catalog_fields = {'kind': 'sample', 'sample': sample}
+    elif not query_set_class:
+        from .connections import database_for
+        from .incremental import collection_watermarks, encode_watermarks, latest_backup, incremental_query_set, \
+            records_watermarks
+
+        catalog_fields = {'kind': 'full'}
+        if records_watermarks(environment, incremental):
+            # watermarks are taken before the dump starts, anything written during it is picked up again next time
+            catalog_fields['watermarks'] = encode_watermarks(collection_watermarks(database_for(environment),
+                                                                                   environment))
+
+        if incremental:
+            parent = latest_backup(backup_catalog(config), env_name)
+            if parent is None:
+                echo("No earlier backup of {} with watermarks, taking a full backup".format(env_name))
+            else:
+                echo("Backing up what changed since {}".format(parent['name']))
+                query_set_class = incremental_query_set(environment, parent)
+                catalog_fields.update({'kind': 'incremental', 'parent': parent['name']})
 
     if 'LOCAL' in config.backups:
-        backup_localy(environment, config.backups['LOCAL'], name, query_set_class)
+        from .local import backup_localy
+        backup_localy(environment, config.backups['LOCAL'], name, query_set_class, environment_name=env_name,
+                      catalog_fields=catalog_fields)
     elif 'S3' in config.backups:
-        backup_to_s3(environment, config.backups['S3'], name, query_set_class)
+        from .s3 import backup_to_s3
+        backup_to_s3(environment, config.backups['S3'], name, query_set_class, environment_name=env_name,
+                     catalog_fields=catalog_fields)
     else:
         exit_with_message('BACKUPS not configured, exiting')
 
 
+def sampling_query_set(environment, sample, sample_method, keep_references):
+    from .sampling import parse_sample, sample_query_set
+    try:
+        parsed_sample = parse_sample(sample)
+    except ValueError as e:
+        exit_with_message(str(e))
+    if keep_references and not environment.get('relationships'):
+        exit_with_message("--keep-references follows the 'relationships' of the source environment, it has none")
+    return sample_query_set(environment, parsed_sample, sample_method, keep_references)
+
+
 @cli.command()
 @pass_config
 def list_backups(config):
     """ Lists available backups
     """
+    _backup_catalog = backup_catalog(config)
+
+    if len(_backup_catalog):
+        echo("{:50} {:>10} {:20} {:8} {}".format('BACKUP', 'SIZE', 'ENVIRONMENT', 'CODEC', 'CREATED AT'))
+        for entry in _backup_catalog:
+            echo("{:50} {:>10} {:20} {:8} {}".format(entry['name'],
+                                                    sizeof_fmt(entry['size']),
+                                                    entry.get('environment') or entry.get('db_name') or '?',
+                                                    entry.get('codec') or '?',
+                                                    entry.get('created_at') or '?'))
+    else:
+        echo()
+        echo('You have not backups yet -- make some?  monarch backup <env_name>')
+        echo()
+
+
+@cli.command(name='rebuild_catalog')
+@pass_config
+def rebuild_catalog(config):
+    """ Rebuilds the backup catalog from what is in backup storage
+
+        Run it once for backups made before the catalog existed, or if backups were added or removed by hand
+    """
     if config.backups is None:
         exit_with_message('BACKUPS not configured, exiting')
 
     if 'LOCAL' in config.backups:
-        list_local_backups(config.backups['LOCAL'])
+        from .local import rebuild_local_catalog
+        _backup_catalog = rebuild_local_catalog(config.backups['LOCAL'])
     elif 'S3' in config.backups:
-        list_s3_backups(config.backups['S3'])
+        from .s3 import rebuild_s3_catalog
+        _backup_catalog = rebuild_s3_catalog(config.backups['S3'])
     else:
         exit_with_message('BACKUPS not configured, exiting')
 
+    echo("Cataloged {} backups".format(len(_backup_catalog)))
+
 
 @cli.command()
 @pass_config
@@ -393,8 +666,10 @@ def list_query_sets(config):
 
 @cli.command()
 @click.argument('from_to')
+@click.option('--skip-indexes', is_flag=True, default=False,
+              help='only restore the _id indexes, handy for throwaway dev restores')
 @pass_config
-def restore(config, from_to):
+def restore(config, from_to, skip_indexes):
     """ Restores a backup into a destination database.  Provide a dump name that you can get from
 
         monarch list_backups
@@ -417,15 +692,34 @@ def restore(config, from_to):
     if to_db not in config.environments:
         exit_with_message('Environments does not have a specification for {}'.format(to_db))
 
-    if backup not in backups(config):
+    _backup_catalog = backup_catalog(config)
+    available_backups = backups(config, catalog=_backup_catalog)
+
+    if backup not in available_backups:
         exit_with_message('Can not find backup {}, run monarch list_backups to see your options'.format(backup))
 
-    msg = 'Are you SURE you want to restore backup into into {}? It will delete the database first'.format(to_db)
+    from .incremental import backup_chain
+    chain = backup_chain(_backup_catalog, backup)
+    if len(chain) > 1:
+        echo("{} is incremental, restoring {}".format(backup, ' then '.join(chain)))
+
+    from .mongo import restore_mode
+    try:
+        mode = restore_mode(config.environments[to_db])
+    except Exception as e:
+        exit_with_message(str(e))
+    if mode == 'swap':
+        consequence = "Its collections are replaced once the backup has loaded beside them"
+    else:
+        consequence = "It will delete the database first"
+    msg = 'Are you SURE you want to restore {} into {}? {}'.format(backup, to_db, consequence)
     if click.confirm(msg):
         echo()
         echo("Okay, you asked for it ...")
         echo()
-        restore_db(config, backups(config)[backup], config.environments[to_db])
+        restore_db(config, available_backups[chain[0]], config.environments[to_db], skip_indexes=skip_indexes)
+        for incremental_backup in chain[1:]:
+            restore_db(config, available_backups[incremental_backup], config.environments[to_db], incremental=True)
 
 
 def confirm_environment(config, env_name):
@@ -435,56 +729,58 @@ def confirm_environment(config, env_name):
         return config.environments[env_name]
 
 
-def list_local_backups(local_config):
+def restore_db(config, path_or_key, to_environment, skip_indexes=False, incremental=False):
+    """unzips the file then runs a restore, incremental backups are applied on top of what is there"""
 
-    _local_backups = local_backups(local_config)
-    if _local_backups:
-        for backup in _local_backups:
-            echo("{:50} {}".format(backup, sizeof_fmt(os.path.getsize(_local_backups[backup]))))
-    else:
-        echo()
-        echo('You have not backups yet -- make some?  monarch backup <env_name>')
-        echo()
+    if config.backups is None:
+        exit_with_message('BACKUPS not configured, exiting')
 
+    from .utils import compression_options
 
-def list_s3_backups(s3_settings):
-    _s3_backups = s3_backups(s3_settings)
-    if _s3_backups:
-        for backup in _s3_backups:
-            echo("{:50} {}".format(backup, sizeof_fmt(_s3_backups[backup].size)))
+    if 'LOCAL' in config.backups:
+        from .local import local_restore
+        workers = compression_options(config.backups['LOCAL'])['workers']
+        return local_restore(path_or_key, to_environment, skip_indexes=skip_indexes, workers=workers,
+                             incremental=incremental)
+    elif 'S3' in config.backups:
+        from .s3 import s3_restore
+        workers = compression_options(config.backups['S3'])['workers']
+        return s3_restore(path_or_key, to_environment, config.backups['S3'],
+                          skip_indexes=skip_indexes, workers=workers, incremental=incremental)
     else:
-        echo()
-        echo('You have not backups yet -- make some?  monarch backup <env_name>')
-        echo()
+        exit_with_message('BACKUPS not configured, exiting')
 
+    echo()
+    echo("Rock and roll that seemed to go well -- Nice work")
+    echo()
 
-def restore_db(config, path_or_key, to_environment):
-    """unzips the file then runs a restore"""
 
+def backup_catalog(config):
+    """returns the Catalog of the configured backup storage"""
     if config.backups is None:
         exit_with_message('BACKUPS not configured, exiting')
 
     if 'LOCAL' in config.backups:
-        return local_restore(path_or_key, to_environment)
+        from .local import local_catalog
+        return local_catalog(config.backups['LOCAL'])
     elif 'S3' in config.backups:
-        return s3_restore(path_or_key, to_environment)
+        from .s3 import s3_catalog
+        return s3_catalog(config.backups['S3'])
     else:
         exit_with_message('BACKUPS not configured, exiting')
 
-    echo()
-    echo("Rock and roll that seemed to go well -- Nice work")
-    echo()
-
 
-def backups(config):
+def backups(config, catalog=None):
     """returns a dictionary of {backup_name: backup_path}"""
     if config.backups is None:
         exit_with_message('BACKUPS not configured, exiting')
 
     if 'LOCAL' in config.backups:
-        return local_backups(config.backups['LOCAL'])
+        from .local import local_backups
+        return local_backups(config.backups['LOCAL'], catalog=catalog)
     elif 'S3' in config.backups:
-        return s3_backups(config.backups['S3'])
+        from .s3 import s3_backups
+        return s3_backups(config.backups['S3'], catalog=catalog)
     else:
         exit_with_message('BACKUPS not configured, exiting')
 
@@ -0,0 +1,178 @@
+"""
+A catalog of backups, kept next to them as monarch_catalog.json
+
+Listing, restoring and naming backups read the catalog in one fetch instead of scanning the backup storage.
+
+A backup running on S3, where a key can not be created only if it is absent, holds its name with a placeholder
+entry (see reservation_entry) until it is done.  Placeholders count when picking names, listings leave them out.
+"""
+import os
+import json
+import struct
+import hashlib
+from datetime import datetime
+from collections import OrderedDict
+
+from .utils import codec_of, strip_codec_suffix
+
+CATALOG_NAME = 'monarch_catalog.json'
+BACKUP_SUFFIX = '.dmp.zip'
+# chunked backups are a manifest of content addressed chunks, see chunks.py
+MANIFEST_SUFFIX = '.dmp.chunks.json'
+
+
+def is_backup_name(name):
+    return name.endswith(BACKUP_SUFFIX) or name.endswith(MANIFEST_SUFFIX)
+
+
+def backup_name_base(environment, name_prefix):
+    if name_prefix and name_prefix != '':
+        return name_prefix
+    else:
+        return environment['db_name']
+
+
+def count_bson_documents(path):
+    """counts the documents of a .bson file by hopping over their length prefixes, without decoding them"""
+    count = 0
+    with open(path, 'rb') as f:
+        while True:
+            prefix = f.read(4)
+            if len(prefix) < 4:
+                return count
+            length = struct.unpack('<i', prefix)[0]
+            f.seek(length - 4, 1)
+            count += 1
+
+
+def describe_dump(dump_path):
+    """returns {collection_name: document count} for a mongodump style directory"""
+    collections = {}
+    for file_name in sorted(os.listdir(dump_path)):
+        if file_name.endswith('.bson'):
+            collections[file_name[:-len('.bson')]] = count_bson_documents(os.path.join(dump_path, file_name))
+    return collections
+
+
+def describe_archive_members(member_names):
+    """what can be told about a backup from its member names alone: (codec, collection names)"""
+    codecs = set(codec_of(name) for name in member_names)
+    codec = codecs.pop() if len(codecs) == 1 else None
+    collections = sorted(strip_codec_suffix(os.path.basename(name))[:-len('.bson')]
+                         for name in member_names if strip_codec_suffix(name).endswith('.bson'))
+    return codec, collections
+
+
+class HashingWriter(object):
+    """Wraps a writable file object and keeps a sha256 of everything written through it
+
+    It does not pass seek on, so zipfile writes a streamed archive and the checksum covers exactly what was written.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.bytes_written += len(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        self.fileobj.flush()
+
+    @property
+    def checksum(self):
+        return 'sha256:{}'.format(self.sha256.hexdigest())
+
+
+def catalog_entry(name, size, environment_name=None, db_name=None, codec=None, collections=None, checksum=None,
+                  **extra):
+    entry = {
+        'name': name,
+        'environment': environment_name,
+        'db_name': db_name,
+        'size': size,
+        'codec': codec,
+        'collections': collections,
+        'checksum': checksum,
+        'created_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    entry.update(extra)
+    return entry
+
+
+def reservation_entry(name, token):
+    """the placeholder a backup holds its name with while it runs"""
+    return {'name': name, 'reserved_by': token, 'created_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+class Catalog(object):
+
+    def __init__(self, entries=None):
+        self.entries = OrderedDict()
+        self._sequence = 0
+        for entry in entries or []:
+            self.add(entry)
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(json.loads(text).get('backups', []))
+
+    def to_json(self):
+        return json.dumps({'backups': list(self.entries.values())}, indent=2, sort_keys=True)
+
+    def add(self, entry):
+        if 'sequence' not in entry and 'reserved_by' not in entry:
+            # orders the backups cataloged within one second, see incremental.latest_backup
+            entry = dict(entry, sequence=self._sequence + 1)
+        self._sequence = max(self._sequence, entry.get('sequence') or 0)
+        self.entries[entry['name']] = entry
+
+    def remove(self, name):
+        self.entries.pop(name, None)
+
+    def get(self, name):
+        entry = self.entries.get(name)
+        return None if entry is None or 'reserved_by' in entry else entry
+
+    def reserved_by(self, name):
+        """the token of the backup holding name with a placeholder, None if it is not reserved"""
+        return (self.entries.get(name) or {}).get('reserved_by')
+
+    def names(self):
+        return [entry['name'] for entry in self]
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __iter__(self):
+        return (entry for entry in self.entries.values() if 'reserved_by' not in entry)
+
+    def __len__(self):
+        return len(self.names())
+
+    def unique_name(self, name_base, suffix=BACKUP_SUFFIX, taken=()):
+        # database_name__2013_03_01.dmp.zip
+        # or if that is taken -- by a backup or placeholder in the catalog, or one of `taken`
+        # database_name__2013_03_01_2.dmp.zip
+        day = datetime.utcnow().strftime("%Y_%m_%d")
+        name_attempt = "{}__{}{}".format(name_base, day, suffix)
+
+        counter = 1
+        while name_attempt in self.entries or name_attempt in taken:
+            counter += 1
+            name_attempt = "{}__{}_{}{}".format(name_base, day, counter, suffix)
+
+        return name_attempt
+
+    def rebuilt(self, found):
+        """a new catalog for the backups `found` in storage ({name: entry}), keeping what is known about them"""
+        catalog = Catalog()
+        for name in sorted(found):
+            catalog.add(self.get(name) or found[name])
+        return catalog
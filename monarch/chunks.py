@@ -0,0 +1,261 @@
+"""
+Content addressed, deduplicated backup storage
+
+With 'storage': 'chunked' in a BACKUPS section, every file of a dump is cut into pieces of about `chunk_size` named
+after the sha256 of their content and stored compressed under chunks/.  A chunk the store already has is neither
+written nor uploaded again, so a collection that did not change since the last backup costs nothing.  The backup
+itself is a small manifest listing the chunks of each file, in order:
+
+    {"chunk_size": 8388608, "files": [{"name": "dogs.bson", "size": 1234, "chunks": ["<sha256>.gz"]}, ...]}
+
+Restores read the chunks back in order, fetching a few ahead, and never put the dump back together on disk unless
+mongorestore needs the files.
+
+`.bson` files are only cut between documents, where the content of the document says to (see bson_chunks), not at
+fixed offsets: a document inserted, deleted or resized moves the boundaries around it but not the ones further on, so
+the rest of the collection is stored again only as far as its next boundary.
+
+Chunks are shared between backups, deleting a manifest leaves its chunks behind.
+"""
+import os
+import json
+import zlib
+import shutil
+import struct
+import hashlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from bson import json_util
+
+from .native import collection_names_of
+from .utils import WorkerPool, COMPRESSION_CODECS, COPY_BUFFER_SIZE, codec_of, compress_bytes, decompress_bytes, \
+    exit_with_message
+
+STORAGE_MODES = ('archive', 'chunked')
+DEFAULT_STORAGE = 'archive'
+
+CHUNK_DIR = 'chunks'
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_PREFETCH = 4
+# a content defined chunk is at least a quarter and at most four times chunk_size
+MIN_CHUNK_FACTOR = 4
+MAX_CHUNK_FACTOR = 4
+# bigger than any document mongodb stores, a length past it means the file is not plain BSON
+MAX_DOCUMENT_SIZE = 48 * 1024 * 1024
+
+
+def storage_mode(backup_settings):
+    storage = backup_settings.get('storage', DEFAULT_STORAGE)
+    if storage not in STORAGE_MODES:
+        exit_with_message('storage [{}] is not supported, choose one of {}'.format(storage, ", ".join(STORAGE_MODES)))
+    return storage
+
+
+def chunk_digest(chunk_name):
+    """the content hash a stored chunk is named after, whatever it was compressed with"""
+    return chunk_name.split('.', 1)[0]
+
+
+def fixed_chunks(f, chunk_size, data=b''):
+    """yields f in chunk_size pieces, starting with data already read from it"""
+    while True:
+        if len(data) < chunk_size:
+            data += f.read(chunk_size - len(data))
+        if not data:
+            return
+        yield data[:chunk_size]
+        data = data[chunk_size:]
+
+
+def _ends_chunk(document, spread):
+    # true for about len(document) in every `spread` bytes of documents
+    return (zlib.crc32(document) & 0xffffffff) < 0xffffffff * min(1.0, float(len(document)) / spread)
+
+
+def bson_chunks(f, chunk_size):
+    """Yields a .bson file in pieces of about chunk_size, each cut after a whole document
+
+    Whether a document ends a chunk depends on nothing but the document: its crc32 is compared against a threshold
+    that grows with its size, so that a cut falls every chunk_size bytes on average.  A chunk is never cut before a
+    quarter of chunk_size and always by four times it.  Falls back to fixed_chunks from where the file stops
+    looking like BSON.
+    """
+    min_size = chunk_size // MIN_CHUNK_FACTOR
+    max_size = chunk_size * MAX_CHUNK_FACTOR
+    spread = max(1, chunk_size - min_size)
+
+    documents, size = [], 0
+    while True:
+        head = f.read(4)
+        if not head:
+            break
+        length = struct.unpack('<i', head)[0] if len(head) == 4 else 0
+        body = f.read(length - 4) if 5 <= length <= MAX_DOCUMENT_SIZE else b''
+        if len(body) != length - 4 or body[-1:] != b'\x00':
+            for chunk in fixed_chunks(f, chunk_size, b''.join(documents) + head + body):
+                yield chunk
+            return
+
+        document = head + body
+        documents.append(document)
+        size += length
+        if size >= max_size or size >= min_size and _ends_chunk(document, spread):
+            yield b''.join(documents)
+            documents, size = [], 0
+
+    if documents:
+        yield b''.join(documents)
+
+
+def _store_chunk(store, chunk_name, data, codec, level):
+    compressed = compress_bytes(data, codec, level)
+    store.put_chunk(chunk_name, compressed)
+    return len(compressed)
+
+
+def store_dump(dump_path, store, codec='none', level=None, chunk_size=DEFAULT_CHUNK_SIZE, workers=1):
+    """Cuts every file of the dump into chunks and stores the ones the store does not have yet
+
+    .bson files are cut between documents by bson_chunks, anything else every chunk_size bytes.
+
+    Chunks are hashed as they are read, only new ones are compressed and written, `workers` at a time.
+    Returns (manifest, stats) where stats counts the chunks and the compressed bytes actually stored.
+    """
+    # sha256: stored chunk name
+    known = store.known_chunks()
+    suffix = COMPRESSION_CODECS[codec][0]
+
+    files = []
+    chunk_count = 0
+    with WorkerPool(workers) as pool:
+        for file_name in sorted(os.listdir(dump_path)):
+            path = os.path.join(dump_path, file_name)
+            chunks = []
+            with open(path, 'rb') as f:
+                pieces = bson_chunks(f, chunk_size) if file_name.endswith('.bson') else fixed_chunks(f, chunk_size)
+                for data in pieces:
+                    digest = hashlib.sha256(data).hexdigest()
+                    if digest not in known:
+                        known[digest] = digest + suffix
+                        pool.submit(_store_chunk, store, known[digest], data, codec, level)
+                    chunks.append(known[digest])
+            chunk_count += len(chunks)
+            files.append({'name': file_name, 'size': os.path.getsize(path), 'chunks': chunks})
+        stored = pool.join()
+
+    manifest = {'chunk_size': chunk_size, 'files': files}
+    stats = {'chunks': chunk_count, 'new_chunks': len(stored), 'new_chunk_bytes': sum(stored)}
+    return manifest, stats
+
+
+def describe_manifest(manifest):
+    """(codec, collection names) of a chunked backup, for catalogs rebuilt from storage"""
+    codecs = set(codec_of(chunk) for entry in manifest['files'] for chunk in entry['chunks'])
+    codec = codecs.pop() if len(codecs) == 1 else None
+    return codec, collection_names_of(entry['name'] for entry in manifest['files'])
+
+
+def manifest_to_json(manifest):
+    return json.dumps(manifest, indent=1, sort_keys=True)
+
+
+def manifest_from_json(text):
+    return json.loads(text)
+
+
+class ChunkReader(object):
+    """A read only file object over a list of chunks, fetching up to `prefetch` of them ahead of the reader"""
+
+    def __init__(self, store, chunk_names, prefetch=DEFAULT_PREFETCH):
+        self.store = store
+        self._names = iter(chunk_names)
+        self._prefetch = max(1, prefetch)
+        self._pool = ThreadPool(self._prefetch)
+        self._pending = deque()
+        self._current = b''
+        self._offset = 0
+        self._fill()
+
+    def _fetch(self, chunk_name):
+        return decompress_bytes(self.store.get_chunk(chunk_name), codec_of(chunk_name))
+
+    def _fill(self):
+        while len(self._pending) < self._prefetch:
+            chunk_name = next(self._names, None)
+            if chunk_name is None:
+                return
+            self._pending.append(self._pool.apply_async(self._fetch, (chunk_name,)))
+
+    def _next_chunk(self):
+        if not self._pending:
+            return False
+        self._current = self._pending.popleft().get()
+        self._offset = 0
+        self._fill()
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size is None or size < 0 or size > 0:
+            if self._offset >= len(self._current) and not self._next_chunk():
+                break
+            end = len(self._current) if size is None or size < 0 else self._offset + size
+            part = self._current[self._offset:end]
+            self._offset += len(part)
+            if size is not None and size > 0:
+                size -= len(part)
+            parts.append(part)
+        return b''.join(parts)
+
+    def close(self):
+        self._pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ChunkedDump(object):
+    """A dump described by a manifest, read chunk by chunk out of a chunk store
+
+    Offers the same reads as native.DirectoryDump and native.ZipDump, so every restore path works on it.
+    """
+
+    def __init__(self, manifest, store, prefetch=DEFAULT_PREFETCH):
+        self.store = store
+        self.prefetch = prefetch
+        self.files = dict((entry['name'], entry) for entry in manifest['files'])
+
+    def collection_names(self):
+        return collection_names_of(self.files)
+
+    def _open(self, file_name):
+        return ChunkReader(self.store, self.files[file_name]['chunks'], self.prefetch)
+
+    def open_bson(self, collection_name):
+        file_name = '{}.bson'.format(collection_name)
+        if file_name not in self.files:
+            return None
+        return self._open(file_name)
+
+    def metadata(self, collection_name):
+        file_name = '{}.metadata.json'.format(collection_name)
+        if file_name not in self.files:
+            return {}
+        with self._open(file_name) as f:
+            return json_util.loads(f.read().decode('utf-8'))
+
+    def extract(self, target_dir, workers=1):
+        """writes the dump into target_dir as plain mongodump files, `workers` files at a time"""
+        def extract_file(file_name):
+            with self._open(file_name) as source:
+                with open(os.path.join(target_dir, file_name), 'wb') as target:
+                    shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+
+        with WorkerPool(workers) as pool:
+            for file_name in self.files:
+                pool.submit(extract_file, file_name)
+            pool.join()
@@ -0,0 +1,168 @@
+"""
+One pooled MongoClient per environment
+
+Every command gets its clients from here, so an environment is connected to once per run however many dumps,
+restores, throttles and migrations use it.  mongoengine, which keeps the migration history and backs document based
+migrations, is handed the same client by establish_datastore_connection.  The client itself always reads from the
+primary.
+
+The client is set up from the environment in ENVIRONMENTS:
+
+    'pool_size': 50,  # most connections open at once, pymongo's maxPoolSize (100 by default)
+    'compressors': ['zstd', 'snappy', 'zlib'],  # wire compression, the first one the server also speaks is used
+    'connect_timeout_ms': 10000,
+    'socket_timeout_ms': 0,  # 0 waits forever, long index builds can take a while
+    'server_selection_timeout_ms': 30000,
+    'read_preference': 'secondaryPreferred',  # read dumps off the secondaries
+
+zstd needs the zstandard package and snappy python-snappy, pymongo leaves out the ones it can not load.
+
+read_preference only applies to the documents dumps read, see dump_database.  Migrations and the migration history
+read from the primary whatever it says: a migration reading stale documents off a lagging secondary would write its
+transforms over newer data.
+"""
+import json
+import threading
+
+try:
+    from urllib.parse import quote_plus
+except ImportError:
+    from urllib import quote_plus
+
+from click import echo
+
+COMPRESSORS = ('zstd', 'snappy', 'zlib')
+READ_PREFERENCES = ('primary', 'primaryPreferred', 'secondary', 'secondaryPreferred', 'nearest')
+
+# ENVIRONMENTS setting: MongoClient option
+CLIENT_OPTIONS = {
+    'pool_size': 'maxPoolSize',
+    'min_pool_size': 'minPoolSize',
+    'compressors': 'compressors',
+    'zlib_compression_level': 'zlibCompressionLevel',
+    'connect_timeout_ms': 'connectTimeoutMS',
+    'socket_timeout_ms': 'socketTimeoutMS',
+    'server_selection_timeout_ms': 'serverSelectionTimeoutMS',
+}
+
+# client key: MongoClient
+_clients = {}
+# mongoengine alias: client key it is bound to
+_documents = {}
+_lock = threading.Lock()
+
+
+def mongo_uri(environment, redact=False):
+    """the connection string of an environment, credentials quoted -- or starred out with redact"""
+    if 'port' in environment:
+        raise Exception("port no longer supported, use the host:port syntax in the host parameter")
+
+    credentials = ''
+    if 'username' in environment:
+        credentials = quote_plus(environment['username'])
+        if 'password' in environment:
+            credentials += ':' + ('****' if redact else quote_plus(environment['password']))
+        credentials += '@'
+
+    uri = 'mongodb://{}{}/{}'.format(credentials, environment['host'], environment['db_name'])
+    if 'sslCAFile' in environment:
+        uri = '{}?ssl=true&ssl_ca_certs={}'.format(uri, quote_plus(environment['sslCAFile']))
+    return uri
+
+
+def client_options(environment):
+    """the MongoClient options set on an environment, see CLIENT_OPTIONS"""
+    options = {}
+    for setting, option in CLIENT_OPTIONS.items():
+        if setting in environment:
+            options[option] = environment[setting]
+
+    if 'compressors' in options:
+        compressors = options['compressors']
+        if not isinstance(compressors, (list, tuple)):
+            compressors = compressors.split(',')
+        unknown = [compressor for compressor in compressors if compressor not in COMPRESSORS]
+        if unknown:
+            raise Exception("compressors must be among {}, got {}".format(", ".join(COMPRESSORS), ", ".join(unknown)))
+        options['compressors'] = ','.join(compressors)
+    return options
+
+
+def read_preference(environment):
+    """the read preference dumps of environment read with, None unless 'read_preference' is set"""
+    name = environment.get('read_preference')
+    if name is not None and name not in READ_PREFERENCES:
+        raise Exception("read_preference must be one of {}, got {}".format(", ".join(READ_PREFERENCES), name))
+    return name
+
+
+def dump_database(database, environment):
+    """database, reading with the read_preference of environment -- for dumps only, writes go to the primary"""
+    name = read_preference(environment)
+    if name is None:
+        return database
+    from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+    return database.with_options(read_preference=make_read_preference(read_pref_mode_from_name(name), None))
+
+
+def _client_key(environment):
+    return mongo_uri(environment) + json.dumps(client_options(environment), sort_keys=True)
+
+
+def _client(key, environment):
+    if key not in _clients:
+        from pymongo import MongoClient
+        options = client_options(environment)
+        echo('connecting to: {}{}'.format(mongo_uri(environment, redact=True),
+                                          ' {}'.format(options) if options else ''))
+        _clients[key] = MongoClient(mongo_uri(environment), **options)
+    return _clients[key]
+
+
+def client_for(environment):
+    """the pooled MongoClient of environment, created the first time it is asked for"""
+    key = _client_key(environment)
+    with _lock:
+        return _client(key, environment)
+
+
+def database_for(environment):
+    """the pymongo Database of environment"""
+    return client_for(environment)[environment['db_name']]
+
+
+def connect_documents(environment, alias=None):
+    """Binds mongoengine's connection to environment, on its pooled client, and returns the client
+
+    Binding another environment to the same alias disconnects the first one.
+    """
+    import mongoengine
+    from mongoengine.connection import DEFAULT_CONNECTION_NAME
+    alias = alias or DEFAULT_CONNECTION_NAME
+
+    key = _client_key(environment)
+    with _lock:
+        if _documents.get(alias) == key:
+            return _clients[key]
+        if alias in _documents:
+            # mongoengine closes the client it disconnects, it can not be handed out again
+            mongoengine.disconnect(alias)
+            _clients.pop(_documents.pop(alias), None)
+
+        client = _client(key, environment)
+        mongoengine.connect(environment['db_name'], alias=alias, host=mongo_uri(environment),
+                            mongo_client_class=lambda **settings: client)
+        _documents[alias] = key
+        return client
+
+
+def close_all():
+    """closes every client, the next client_for connects again"""
+    import mongoengine
+    with _lock:
+        for alias in list(_documents):
+            mongoengine.disconnect(alias)
+        _documents.clear()
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
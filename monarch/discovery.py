@@ -0,0 +1,188 @@
+"""
+Finds migration and query set classes without importing their modules
+
+Files are parsed, not imported, and the classes they define are remembered per file along with its mtime and size,
+in memory and in <directory>/__pycache__/monarch_index.json, so unchanged files are not even parsed again.  A module is
+only imported when its class is loaded -- i.e. when the migration or query set is about to run.
+"""
+import os
+import re
+import ast
+import sys
+import json
+import threading
+from glob import glob
+from importlib import import_module
+
+INDEX_DIR = '__pycache__'
+INDEX_NAME = 'monarch_index.json'
+
+# directory: {file name: [mtime, size, classes_in(file)]}
+_indexes = {}
+_index_lock = threading.Lock()
+
+
+def _base_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    return None
+
+
+def _literal(node):
+    """the value of a literal expression as plain json, raises ValueError if it is not one"""
+    value = ast.literal_eval(node)
+    if isinstance(value, (set, frozenset, tuple)):
+        value = sorted(value) if isinstance(value, (set, frozenset)) else list(value)
+    json.dumps(value)
+    return value
+
+
+def classes_in(path):
+    """Describes the classes defined at the top level of a python file, without running it
+
+    Returns {class name: {'bases': [names], 'literals': {attribute: value}, 'dynamic': [attributes]}} where
+    literals are the class attributes assigned plain literals and dynamic the ones assigned anything else.
+    """
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    classes = {}
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        literals, dynamic = {}, []
+        for statement in node.body:
+            if not isinstance(statement, ast.Assign):
+                continue
+            for target in statement.targets:
+                if not isinstance(target, ast.Name):
+                    continue
+                try:
+                    literals[target.id] = _literal(statement.value)
+                except (ValueError, TypeError, SyntaxError):
+                    dynamic.append(target.id)
+        classes[node.name] = {'bases': [_base_name(base) for base in node.bases],
+                              'literals': literals,
+                              'dynamic': dynamic}
+    return classes
+
+
+def _index_path(directory):
+    return os.path.join(directory, INDEX_DIR, INDEX_NAME)
+
+
+def _read_index(directory):
+    if directory not in _indexes:
+        try:
+            with open(_index_path(directory)) as f:
+                _indexes[directory] = json.load(f)
+        except (IOError, OSError, ValueError):
+            _indexes[directory] = {}
+    return _indexes[directory]
+
+
+def _write_index(directory, index):
+    index_dir = os.path.join(directory, INDEX_DIR)
+    try:
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        with open(_index_path(directory) + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.rename(_index_path(directory) + '.tmp', _index_path(directory))
+    except (IOError, OSError):
+        # a read only checkout just means parsing again next time
+        pass
+
+
+def scan_directory(directory, pattern):
+    """returns {file path: classes_in(path)} for the files matching pattern, parsing only new or changed files"""
+    found = {}
+    with _index_lock:
+        index = _read_index(directory)
+        changed = False
+        for path in sorted(glob(os.path.join(directory, pattern))):
+            file_name = os.path.basename(path)
+            stat = os.stat(path)
+            cached = index.get(file_name)
+            if cached is None or cached[0] != stat.st_mtime or cached[1] != stat.st_size \
+                    or not isinstance(cached[2], dict):
+                cached = [stat.st_mtime, stat.st_size, classes_in(path)]
+                index[file_name] = cached
+                changed = True
+            found[path] = cached[2]
+
+        for file_name in list(index):
+            if not os.path.exists(os.path.join(directory, file_name)):
+                del index[file_name]
+                changed = True
+
+        if changed:
+            _write_index(directory, index)
+    return found
+
+
+def invalidate_import_caches():
+    if sys.version_info >= (3, 3):
+        from importlib import invalidate_caches
+        invalidate_caches()
+
+
+class DiscoveredClass(object):
+    """Stands in for a class found by scanning, importing its module the first time it is loaded or called"""
+
+    def __init__(self, module_name, class_name, path, description=None, plain_bases=()):
+        self.module_name = module_name
+        self.class_name = class_name
+        self.path = path
+        self.description = description or {'bases': [], 'literals': {}, 'dynamic': []}
+        self.plain_bases = plain_bases
+        self._cls = None
+
+    def static_attribute(self, name, default=None):
+        """A class attribute, read from the source when it is a literal there
+
+        The class is imported only if the attribute is computed, or may come from a base class other than
+        plain_bases.
+        """
+        if self._cls is None:
+            if name in self.description['literals']:
+                return self.description['literals'][name]
+            if name not in self.description['dynamic'] and \
+                    all(base in self.plain_bases for base in self.description['bases']):
+                return default
+        return getattr(self.load(), name, default)
+
+    def load(self):
+        if self._cls is None:
+            self._cls = getattr(import_module(self.module_name), self.class_name)
+        return self._cls
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __repr__(self):
+        return '<{} {}.{} (not imported)>'.format(self.__class__.__name__, self.module_name, self.class_name) \
+            if self._cls is None else repr(self._cls)
+
+
+def discover(directory, pattern, package, name_re, excluded=()):
+    """Returns [(module name, DiscoveredClass)] for every file in directory matching pattern
+
+    The class of a module is the last one, alphabetically, whose name matches name_re and is not excluded.  The
+    excluded names are taken to be monarch's own base classes, which set no attributes that static_attribute
+    would have to import the class for.
+    """
+    invalidate_import_caches()
+
+    discovered = []
+    for path, classes in sorted(scan_directory(directory, pattern).items()):
+        module_name = os.path.splitext(os.path.basename(path))[0]
+        matching = sorted(name for name in classes if re.search(name_re, name) and name not in excluded)
+        if matching:
+            class_name = matching[-1]
+            discovered.append((module_name, DiscoveredClass('{}.{}'.format(package, module_name), class_name, path,
+                                                            description=classes[class_name],
+                                                            plain_bases=excluded)))
+    return discovered
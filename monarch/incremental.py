@@ -0,0 +1,121 @@
+"""
+Incremental backups
+
+Every backup records a watermark per collection: the highest value of that collection's watermark field when the
+backup started.  An incremental backup only dumps the documents above its parent's watermarks, and a restore replays
+the chain -- the full backup, then each incremental upserted on top of it.
+
+The watermark field is `_id` unless set per collection with 'watermark_fields' on the environment, i.e.
+
+    'watermark_fields': {'dogs': 'updated_at', '*': '_id'}
+
+ObjectIds only ever grow on insert, so `_id` catches new documents; use an updated-at field to catch updates too.
+Deletes are never carried over by an incremental backup.
+
+Finding a watermark sorts the collection on its field, index the fields you set.  Plain backups only record
+watermarks for environments that set 'watermark_fields', a backup with --incremental always does.
+"""
+import json
+
+from bson import json_util
+from click import echo
+
+from .models import QuerySet
+from .native import application_collection_names
+
+DEFAULT_WATERMARK_FIELD = '_id'
+
+
+def watermark_field(environment, collection_name):
+    fields = environment.get('watermark_fields', {})
+    return fields.get(collection_name, fields.get('*', DEFAULT_WATERMARK_FIELD))
+
+
+def records_watermarks(environment, incremental=False):
+    """whether a full backup of environment takes watermarks, for the incremental backups after it"""
+    return incremental or 'watermark_fields' in environment
+
+
+def _get_field(document, field):
+    for part in field.split('.'):
+        if not isinstance(document, dict) or part not in document:
+            return None
+        document = document[part]
+    return document
+
+
+def collection_watermarks(database, environment):
+    """{collection_name: highest value of its watermark field}, empty collections are left out"""
+    watermarks = {}
+    for collection_name in application_collection_names(database):
+        field = watermark_field(environment, collection_name)
+        indexed = [index['key'][0][0] for index in database[collection_name].index_information().values()]
+        if field not in indexed:
+            echo("{}.{} has no index, its watermark is found by sorting the whole collection".format(
+                collection_name, field))
+        cursor = database[collection_name].find({field: {'$exists': True}}, {field: 1}).sort(field, -1).limit(1)
+        for document in cursor:
+            watermarks[collection_name] = _get_field(document, field)
+    return watermarks
+
+
+def encode_watermarks(watermarks):
+    """watermarks as plain json (extended json for ObjectIds, dates and the like) for the catalog"""
+    return json.loads(json_util.dumps(watermarks))
+
+
+def decode_watermarks(encoded):
+    return json_util.loads(json.dumps(encoded or {}))
+
+
+def latest_backup(catalog, environment_name):
+    """the most recent backup of environment_name that recorded watermarks, or None"""
+    candidates = [entry for entry in catalog
+                  if entry.get('environment') == environment_name and entry.get('watermarks') is not None]
+    if not candidates:
+        return None
+    # created_at goes down to the second, the catalog's sequence orders the backups made within one
+    return max(candidates, key=lambda entry: (entry.get('created_at') or '', entry.get('sequence') or 0))
+
+
+def backup_chain(catalog, backup_name):
+    """the backups to restore, in order, to rebuild backup_name -- the full backup first"""
+    chain = []
+    entry = catalog.get(backup_name)
+    while entry is not None:
+        chain.insert(0, entry['name'])
+        if entry.get('kind') != 'incremental':
+            return chain
+        if entry.get('parent') in chain:
+            raise Exception("backup chain of {} loops back on {}".format(backup_name, entry['parent']))
+        entry = catalog.get(entry.get('parent'))
+
+    raise Exception("backup chain of {} is broken, the full backup it builds on is missing".format(backup_name))
+
+
+class IncrementalQuerySet(QuerySet):
+    """Dumps the documents of each collection above the parent backup's watermark"""
+
+    watermark_fields = {}
+    parent_watermarks = {}
+
+    def run(self):
+        for collection_name in self.application_collection_names:
+            watermark = self.parent_watermarks.get(collection_name)
+            if watermark is None:
+                # new since the parent, take all of it
+                self.dump_collection(collection_name)
+            else:
+                field = watermark_field({'watermark_fields': self.watermark_fields}, collection_name)
+                self.dump_collection(collection_name, {field: {'$gt': watermark}})
+
+    def only(self):
+        return self.touched_collections
+
+
+def incremental_query_set(environment, parent_entry):
+    """an IncrementalQuerySet class picking up where parent_entry left off"""
+    return type('IncrementalQuerySet', (IncrementalQuerySet,), {
+        'watermark_fields': environment.get('watermark_fields', {}),
+        'parent_watermarks': decode_watermarks(parent_entry['watermarks']),
+    })
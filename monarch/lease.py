@@ -0,0 +1,68 @@
+"""
+Leases, so several runners can share the pending migrations
+
+Before a migration runs, its runner claims it with one atomic findAndModify that only matches when nobody holds a
+live lease on it (see MongoMigrationHistory.claim_by_key).  While the migration runs a Heartbeat pushes the lease
+expiry forward every third of the lease; when it is done the lease is released.  A runner that dies stops renewing,
+its lease runs out and the next runner to come along can claim the migration -- which then counts as Failed, so it
+is resumed from its checkpoint or restarted on purpose, never run twice by accident.
+
+A runner that stalls past its lease (a long GC pause, a network partition) may find, once it wakes up, that another
+runner took the migration over.  Its heartbeat then flags the lease lost, the batch helpers stop at the next batch,
+and its state and checkpoint writes, which only match while it still owns the record, raise LeaseLost instead of
+landing on top of the new owner's.
+
+Lease expiries are compared with the runners' clocks, keep them within a fraction of the lease of each other.
+"""
+import os
+import uuid
+import socket
+import threading
+
+from click import echo
+
+DEFAULT_LEASE_SECONDS = 60
+
+# identifies this process to the others sharing the migrations
+RUNNER_ID = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class LeaseLost(Exception):
+    """Raised when a runner finds another one took over the migration it was running"""
+
+
+class Heartbeat(object):
+    """Calls renew() every `interval` seconds from a background thread until stopped
+
+    renew returns False once the lease was lost -- taken over after it expired -- which is flagged in `lost`.
+    """
+
+    def __init__(self, renew, interval, label=None):
+        self.renew = renew
+        self.interval = interval
+        self.label = label
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._beat, name='monarch-heartbeat')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _beat(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                renewed = self.renew()
+            except Exception as e:
+                # the next beat may get through, the lease only lapses after several missed ones
+                echo("Could not renew the lease of {}: [{}]".format(self.label, e))
+                continue
+            if not renewed:
+                self.lost = True
+                echo("Lost the lease of {}, another runner may pick it up".format(self.label))
+                return
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
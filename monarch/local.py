@@ -1,20 +1,65 @@
 import os
-import shutil
+import time
+import errno
+import hashlib
 import zipfile
-from datetime import datetime
+from contextlib import contextmanager
 
-from .mongo import restore, dump_db
-from .utils import temp_directory, exit_with_message, zipdir
+from click import echo
 
+from .mongo import restore_archive, restore_from_dump, dump_db
+from .utils import exit_with_message, zipdir, compression_options
+from .chunks import ChunkedDump, CHUNK_DIR, DEFAULT_CHUNK_SIZE, storage_mode, store_dump, chunk_digest, \
+    describe_manifest, manifest_to_json, manifest_from_json
+from .catalog import Catalog, CATALOG_NAME, BACKUP_SUFFIX, MANIFEST_SUFFIX, HashingWriter, catalog_entry, \
+    describe_dump, describe_archive_members, backup_name_base, is_backup_name
 
-def local_restore(zip_path, to_environment):
-    zip = zipfile.ZipFile(zip_path)
-    with temp_directory() as temp_dir:
-        zip.extractall(path=temp_dir)
-        restore(temp_dir, to_environment)
 
+def local_restore(zip_path, to_environment, skip_indexes=False, workers=1, incremental=False):
+    if zip_path.endswith(MANIFEST_SUFFIX):
+        with open(zip_path) as f:
+            manifest = manifest_from_json(f.read())
+        store = LocalChunkStore(os.path.join(os.path.dirname(zip_path), CHUNK_DIR))
+        restore_from_dump(ChunkedDump(manifest, store), to_environment, skip_indexes=skip_indexes, workers=workers,
+                          incremental=incremental)
+        return
 
-def local_backups(local_config):
+    with zipfile.ZipFile(zip_path) as zip:
+        restore_archive(zip, to_environment, skip_indexes=skip_indexes, workers=workers, incremental=incremental)
+
+
+class LocalChunkStore(object):
+    """The chunks of chunked backups, one file each in <backup_dir>/chunks"""
+
+    def __init__(self, chunk_dir):
+        self.chunk_dir = chunk_dir
+
+    def known_chunks(self):
+        if not os.path.isdir(self.chunk_dir):
+            return {}
+        return dict((chunk_digest(name), name) for name in os.listdir(self.chunk_dir) if not name.endswith('.tmp'))
+
+    def put_chunk(self, chunk_name, data):
+        if not os.path.isdir(self.chunk_dir):
+            try:
+                os.makedirs(self.chunk_dir)
+            except OSError:
+                # another worker got there first
+                if not os.path.isdir(self.chunk_dir):
+                    raise
+
+        path = os.path.join(self.chunk_dir, chunk_name)
+        # write then rename, an interrupted backup never leaves a partial chunk that later backups would trust
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+
+    def get_chunk(self, chunk_name):
+        with open(os.path.join(self.chunk_dir, chunk_name), 'rb') as f:
+            return f.read()
+
+
+def local_backup_dir(local_config):
     if 'backup_dir' not in local_config:
         exit_with_message('Local Settings not configured correctly, expecting "backup_dir"')
 
@@ -23,57 +68,188 @@ def local_backups(local_config):
     if not os.path.isdir(backup_dir):
         exit_with_message('Directory [{}] does not exist.  Exiting ...'.format(backup_dir))
 
-    backups = {}
-    for item in os.listdir(backup_dir):
-        backups[item] = os.path.join(backup_dir, item)
+    return backup_dir
 
-    return backups
 
+def local_catalog(local_config):
+    """reads the catalog of backup_dir, building it first if this backup_dir has never had one"""
+    backup_dir = local_backup_dir(local_config)
+    catalog_path = os.path.join(backup_dir, CATALOG_NAME)
 
-def backup_localy(environment, local_settings, name, query_set_class=None):
+    if not os.path.exists(catalog_path):
+        return rebuild_local_catalog(local_config)
 
-    if 'backup_dir' not in local_settings:
-        exit_with_message('Local Settings not configured correctly, expecting "backup_dir"')
+    with open(catalog_path) as f:
+        return Catalog.from_json(f.read())
 
-    backup_dir = local_settings['backup_dir']
 
-    if not os.path.isdir(backup_dir):
-        exit_with_message('Directory [{}] does not exist.  Exiting ...'.format(backup_dir))
+def save_local_catalog(local_config, catalog):
+    catalog_path = os.path.join(local_backup_dir(local_config), CATALOG_NAME)
+    # write then rename, so a reader never sees half a catalog
+    with open(catalog_path + '.tmp', 'w') as f:
+        f.write(catalog.to_json())
+    os.rename(catalog_path + '.tmp', catalog_path)
 
-    dump_path = dump_db(environment, QuerySet=query_set_class)
-    zipf = zipdir(dump_path)
 
-    unique_file_path = generate_unique_name(backup_dir, environment, name)
+# a catalog lock older than this was left behind by a backup that died holding it
+CATALOG_LOCK_SECONDS = 60
+
+
+@contextmanager
+def updating_local_catalog(local_config):
+    """the current catalog, saved after the block changes it -- under a lock file, so backups finishing at the same
+    time do not drop each other's entries"""
+    lock_path = os.path.join(local_backup_dir(local_config), CATALOG_NAME + '.lock')
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            if time.time() - os.path.getmtime(lock_path) > CATALOG_LOCK_SECONDS:
+                os.remove(lock_path)
+                continue
+        except OSError:
+            # released meanwhile
+            continue
+        time.sleep(0.05)
+
+    try:
+        catalog = local_catalog(local_config)
+        yield catalog
+        save_local_catalog(local_config, catalog)
+    finally:
+        os.remove(lock_path)
+
+
+def rebuild_local_catalog(local_config):
+    """scans backup_dir and records every backup in the catalog, keeping what the catalog already knew"""
+    backup_dir = local_backup_dir(local_config)
+    catalog_path = os.path.join(backup_dir, CATALOG_NAME)
+
+    known = Catalog()
+    if os.path.exists(catalog_path):
+        with open(catalog_path) as f:
+            known = Catalog.from_json(f.read())
+
+    found = {}
+    for item in os.listdir(backup_dir):
+        path = os.path.join(backup_dir, item)
+        if not is_backup_name(item) or not os.path.isfile(path) or not os.path.getsize(path):
+            # empty ones are names reserved by backups still running
+            continue
+        codec, collections = None, None
+        if item.endswith(MANIFEST_SUFFIX):
+            with open(path) as f:
+                manifest = manifest_from_json(f.read())
+            codec, collections = describe_manifest(manifest)
+            found[item] = catalog_entry(item, os.path.getsize(path), codec=codec, storage='chunked',
+                                        collections=dict((name, None) for name in collections))
+            continue
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as zip:
+                codec, collections = describe_archive_members(zip.namelist())
+        found[item] = catalog_entry(item, os.path.getsize(path), codec=codec,
+                                    collections=dict((name, None) for name in collections or []))
+
+    catalog = known.rebuilt(found)
+    save_local_catalog(local_config, catalog)
+    return catalog
+
+
+def local_backups(local_config, catalog=None):
+    """a dict of backup name: path, read from the catalog"""
+    backup_dir = local_backup_dir(local_config)
+
+    backups = {}
+    if catalog is None:
+        catalog = local_catalog(local_config)
+
+    for entry in catalog:
+        backups[entry['name']] = os.path.join(backup_dir, entry['name'])
+
+    return backups
 
-    shutil.move(zipf.filename, unique_file_path)
 
+def backup_localy(environment, local_settings, name, query_set_class=None, environment_name=None,
+                  catalog_fields=None):
 
-def generate_unique_name(backup_dir, environemnt, name_prefix):
+    backup_dir = local_backup_dir(local_settings)
+    catalog = local_catalog(local_settings)
+
+    dump_path = dump_db(environment, QuerySet=query_set_class)
+    compression = compression_options(local_settings)
+    catalog_fields = dict(catalog_fields or {})
+
+    chunked = storage_mode(local_settings) == 'chunked'
+    unique_file_path = reserve_unique_name(backup_dir, environment, name, catalog=catalog,
+                                           suffix=MANIFEST_SUFFIX if chunked else BACKUP_SUFFIX)
+    try:
+        if chunked:
+            store = LocalChunkStore(os.path.join(backup_dir, CHUNK_DIR))
+            manifest, stats = store_dump(dump_path, store, codec=compression['codec'], level=compression['level'],
+                                         chunk_size=local_settings.get('chunk_size', DEFAULT_CHUNK_SIZE),
+                                         workers=compression['workers'])
+            manifest_json = manifest_to_json(manifest).encode('utf-8')
+            with open(unique_file_path, 'wb') as f:
+                f.write(manifest_json)
+
+            size = len(manifest_json)
+            checksum = 'sha256:{}'.format(hashlib.sha256(manifest_json).hexdigest())
+            catalog_fields.update(stats, storage='chunked')
+            echo("Stored {new_chunks} new of {chunks} chunks ({new_chunk_bytes} bytes)".format(**stats))
+        else:
+            with open(unique_file_path, 'wb') as f:
+                archive = HashingWriter(f)
+                zipdir(dump_path, target=archive, **compression)
+
+            size, checksum = archive.bytes_written, archive.checksum
+    except Exception:
+        # give the name back
+        os.remove(unique_file_path)
+        raise
+
+    # re-read under the lock, another backup may have been cataloged while this one ran
+    with updating_local_catalog(local_settings) as catalog:
+        catalog.add(catalog_entry(os.path.basename(unique_file_path), size,
+                                  environment_name=environment_name,
+                                  db_name=environment['db_name'],
+                                  codec=compression['codec'],
+                                  collections=describe_dump(dump_path),
+                                  checksum=checksum,
+                                  **catalog_fields))
+
+
+def generate_unique_name(backup_dir, environemnt, name_prefix, catalog=None, suffix=BACKUP_SUFFIX):
     # generate_file_name
     # database_name__2013_03_01.dmp.zip
     # or if that exists
-    # database_name__2013_03_01(2).dmp.zip
-
-    if name_prefix and name_prefix != '':
-        name_base = name_prefix
-    else:
-        name_base = environemnt['db_name']
-
-    name_attempt = "{}__{}.dmp.zip".format(name_base, datetime.utcnow().strftime("%Y_%m_%d"))
-
-    # check if file exists
-    name_attempt_full_path = os.path.join(backup_dir, name_attempt)
-
-    if not os.path.exists(name_attempt_full_path):
-        return name_attempt_full_path
-    else:
-        counter = 1
-        while True:
-            counter += 1
-            name_attempt = "{}__{}_{}.dmp.zip".format(name_base,
-                                                      datetime.utcnow().strftime("%Y_%m_%d"), counter)
-            name_attempt_full_path = os.path.join(backup_dir, name_attempt)
-            if os.path.exists(name_attempt_full_path):
-                continue
-            else:
-                return name_attempt_full_path
+    # database_name__2013_03_01_2.dmp.zip
+    if catalog is None:
+        catalog = local_catalog({'backup_dir': backup_dir})
+
+    name_base = backup_name_base(environemnt, name_prefix)
+    return os.path.join(backup_dir, catalog.unique_name(name_base, suffix))
+
+
+def reserve_unique_name(backup_dir, environment, name_prefix, catalog=None, suffix=BACKUP_SUFFIX):
+    """Like generate_unique_name, and creates the file, so a backup running alongside can not pick the same name
+
+    The create only succeeds if the file is absent (O_EXCL), a name taken in the meantime moves on to the next.
+    """
+    if catalog is None:
+        catalog = local_catalog({'backup_dir': backup_dir})
+
+    name_base = backup_name_base(environment, name_prefix)
+    taken = set()
+    while True:
+        path = os.path.join(backup_dir, catalog.unique_name(name_base, suffix, taken=taken))
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            taken.add(os.path.basename(path))
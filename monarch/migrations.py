@@ -1,16 +1,15 @@
 import os
-import re
 import sys
 import errno
-import inspect
 import collections
-from glob import glob
 from datetime import datetime
-from importlib import import_module
 
-# 3rd Party
+from six import reraise
+from six.moves import queue
 from click import echo
 
+from .discovery import discover
+
 
 def generate_migration_name(folder, name):
     # Can not start with a number so starting with a underscore
@@ -37,18 +36,120 @@ def create_package_if_necessary(dir):
 
 
 def find_migrations(config):
-    migrations = {}
-    for file in glob('{}/*_migration.py'.format(config.migration_directory)):
-        migration_name = os.path.splitext(os.path.basename(file))[0]
-        if sys.version_info >= (3, 3):
-            from importlib import invalidate_caches
-            invalidate_caches()
-        migration_module = import_module("migrations.{}".format(migration_name))
-        for name, obj in inspect.getmembers(migration_module):
-            if inspect.isclass(obj) and re.search('Migration$', name) and name not in ['BaseMigration',
-                                                                                       'MongoBackedMigration']:
-                migrations[migration_name] = obj
+    """returns an ordered {migration name: migration class}, the modules are imported once a class is used"""
+    migrations = discover(config.migration_directory, '*_migration.py', 'migrations', 'Migration$',
+                          excluded=('Migration', 'BaseMigration', 'MongoBackedMigration'))
 
     # 2) Ensure that the are ordered
-    ordered = collections.OrderedDict(sorted(migrations.items()))
-    return ordered
\ No newline at end of file
+    ordered = collections.OrderedDict(sorted(migrations))
+    return ordered
+
+
+def migration_attribute(migration_class, name, default=None):
+    """reads a class attribute, from the source when find_migrations has not imported the class yet"""
+    if hasattr(migration_class, 'static_attribute'):
+        return migration_class.static_attribute(name, default)
+    return getattr(migration_class, name, default)
+
+
+def migration_graph(migrations):
+    """Returns {migration name: set of the migrations that have to run before it}
+
+    A migration waits for the ones it lists in `depends_on` (by migration name or class name) and for every earlier
+    migration that touches one of the same `collections`.  A migration that does not declare its collections could
+    touch anything, so it waits for everything before it and everything after it waits for it -- without
+    declarations migrations run one at a time in file name order, as they always have.
+    """
+    names = list(migrations)
+    by_class_name = dict((getattr(migrations[name], 'class_name', None) or migrations[name].__name__, name)
+                         for name in names)
+
+    graph = collections.OrderedDict()
+    # the last migration that did not declare its collections, and the ones declared since
+    last_barrier, since_barrier = None, []
+    last_by_collection = {}
+
+    for position, name in enumerate(names):
+        migration_class = migrations[name]
+        prerequisites = set()
+
+        for dependency in migration_attribute(migration_class, 'depends_on', None) or []:
+            dependency_name = dependency if dependency in migrations else by_class_name.get(dependency)
+            if dependency_name is None:
+                raise Exception("{} depends on {}, which is not a migration".format(name, dependency))
+            if names.index(dependency_name) >= position:
+                raise Exception("{} depends on {}, which sorts after it".format(name, dependency_name))
+            prerequisites.add(dependency_name)
+
+        collection_names = migration_attribute(migration_class, 'collections', None)
+        if collection_names is None:
+            if since_barrier:
+                prerequisites.update(since_barrier)
+            elif last_barrier is not None:
+                prerequisites.add(last_barrier)
+            last_barrier, since_barrier, last_by_collection = name, [], {}
+        else:
+            for collection_name in collection_names:
+                previous = last_by_collection.get(collection_name, last_barrier)
+                if previous is not None:
+                    prerequisites.add(previous)
+                last_by_collection[collection_name] = name
+            if last_barrier is not None:
+                prerequisites.add(last_barrier)
+            since_barrier.append(name)
+
+        graph[name] = prerequisites
+    return graph
+
+
+def run_migration_graph(graph, run, workers=1):
+    """Calls run(name) for each migration of graph once everything it waits for has run, `workers` at a time
+
+    run returns whether the migrations waiting on this one may go ahead, those waiting on one that may not are
+    skipped.  After a
+    failure nothing new is started, the migrations already running finish and then the failure is raised.
+    Returns the names of the skipped migrations.
+    """
+    waiting_on = collections.OrderedDict((name, set(prerequisites)) for name, prerequisites in graph.items())
+    finished = queue.Queue()
+    failures = []
+    running = 0
+
+    def task(name):
+        try:
+            finished.put((name, run(name), None))
+        except Exception:
+            finished.put((name, False, sys.exc_info()))
+
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        while waiting_on or running:
+            if not failures:
+                ready = [name for name, prerequisites in waiting_on.items() if not prerequisites]
+                for name in ready[:max(1, workers) - running]:
+                    del waiting_on[name]
+                    pool.apply_async(task, (name,))
+                    running += 1
+
+            if not running:
+                break
+
+            name, completed, failure = finished.get()
+            running -= 1
+            if failure is not None:
+                failures.append(failure)
+            elif completed:
+                for prerequisites in waiting_on.values():
+                    prerequisites.discard(name)
+    finally:
+        pool.close()
+        pool.join()
+
+    if failures:
+        reraise(*failures[0])
+
+    if waiting_on:
+        echo("Skipped, waiting on migrations that did not complete: {}".format(", ".join(waiting_on)))
+    return list(waiting_on)
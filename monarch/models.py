@@ -1,13 +1,26 @@
 import os
 import re
 import sys
+import time
+import shutil
 import inspect
+import tempfile
 import subprocess
-from copy import copy
+from copy import copy, deepcopy
+from collections import namedtuple
+from contextlib import contextmanager
 
 # 3rd Party
 import click
 from click import echo
+from bson import json_util
+from pymongo.errors import CollectionInvalid
+
+from . import native
+from .lease import DEFAULT_LEASE_SECONDS
+from .subsets import DEFAULT_IN_BATCH_SIZE, in_queries, related_ids
+from .telemetry import RunTelemetry
+from .utils import WorkerPool
 
 
 class Migration(object):
@@ -20,6 +33,26 @@ class Migration(object):
     STATE_FAILED = 'Failed'
     STATE_COMPLETED = 'Completed'
 
+    # names (or class names) of the migrations that have to run before this one
+    depends_on = []
+    # the collections this migration touches, None means it could touch any of them.  Migrations that declare
+    # their collections run alongside the ones they share no collection with -- see migrations.migration_graph
+    collections = None
+    # how long a runner's claim on the migration lasts without a heartbeat, see lease.py
+    lease_seconds = DEFAULT_LEASE_SECONDS
+
+    def __init__(self, history=None, throttle=None):
+        """history is where state is kept, subclasses pick a default when none is shared with them.
+        throttle, when given, paces batch helpers such as MongoBackedMigration.process_in_batches"""
+        self.history = history
+        self.throttle = throttle
+        # where a resumed run picks up, see save_checkpoint
+        self.checkpoint = None
+        # the checkpoint as it was when this run resumed from it, self.checkpoint moves on as the run saves progress
+        self.resumed_checkpoint = None
+        # figures of the current run, see count_documents and record_run
+        self.telemetry = RunTelemetry()
+
     @property
     def migration_key(self):
         migration_file = inspect.getfile(self.__class__)
@@ -37,44 +70,249 @@ class Migration(object):
     def status(self):
         raise NotImplementedError("This is an abstract class")
 
-    def process(self, force=False):
+    def save_checkpoint(self, checkpoint):
+        """Records how far the migration got, a dict of whatever run() needs to pick up from there
+
+        If the migration dies, the next process() offers to resume and hands it back as self.checkpoint.
+        """
+        raise NotImplementedError("This is an abstract class")
+
+    @property
+    def saved_checkpoint(self):
+        """the checkpoint recorded by the last run, or None"""
+        return None
+
+    def count_documents(self, read=0, written=0):
+        """adds to the documents this run read and wrote, batch helpers call it for you"""
+        self.telemetry.count(read=read, written=written)
+
+    def record_run(self, telemetry):
+        """Keeps the figures of a finished run -- see telemetry.TELEMETRY_FIELDS -- successful or not
+
+        Nothing is kept unless a subclass stores them.
+        """
+        pass
+
+    @contextmanager
+    def claimed(self):
+        """Holds the migration for this runner while the block runs, yields False if another runner holds it
+
+        Only a shared history can tell runners apart, this one always yields True.
+        """
+        yield True
+
+    def process(self, force=False, resume=None):
+        """Runs the migration if it is new, or whatever its state if forced
+
+        A migration that stopped (Processing or Failed) after saving a checkpoint can resume from it -- resume=None
+        asks, True or False decides up front.  A migration that is going to run is claimed first, one held by another
+        runner is skipped and False returned.
+        """
         click.echo("Processing {}".format(self.migration_name))
 
-        if self.status == Migration.STATE_NEW or force:
-            self.update_status(Migration.STATE_PROCESSING)
-            echo("Starting: {}".format(self.migration_name))
-            try:
-                self.run()
-            except Exception:
-                echo("Migration {} Failed".format(self.migration_name))
-                typ, value, traceback = sys.exc_info()
-                echo("Unexpected error: [{}]".format(typ))
-                echo("Unexpected value: [{}]".format(value))
-                echo("Unexpected traceback: [{}]".format(traceback))
-                self.update_status(Migration.STATE_FAILED)
-                raise
-            else:
-                echo("Migration {} Successful".format(self.migration_name))
-                self.update_status(Migration.STATE_COMPLETED)
-        elif self.status == Migration.STATE_PROCESSING:
+        if not (force or self._would_run(resume)):
+            # completed, or left as it is -- nothing to claim, the status says so
+            self._process(force, resume)
+            return True
+
+        with self.claimed() as claimed:
+            if not claimed:
+                echo("{} is being processed by another runner, skipping it".format(self.migration_name))
+                return False
+            self._process(force, resume)
+            return True
+
+    def _would_run(self, resume):
+        """whether process() would run the migration going by its current status, without being forced"""
+        status = self.status
+        return Migration.would_run(status, status != Migration.STATE_NEW and self.saved_checkpoint, resume)
+
+    @staticmethod
+    def would_run(state, checkpoint, resume):
+        """whether a migration in state, with checkpoint saved, runs when processed -- readable off the history
+        without importing the migration"""
+        if state == Migration.STATE_NEW:
+            return True
+        return state in (Migration.STATE_PROCESSING, Migration.STATE_FAILED) and resume is not False and \
+            bool(checkpoint)
+
+    def _process(self, force, resume):
+        status = self.status
+        checkpoint = None
+        if status in (Migration.STATE_PROCESSING, Migration.STATE_FAILED):
+            checkpoint = self.saved_checkpoint
+
+        if checkpoint and resume is None:
+            resume = click.confirm("{} stopped ({}) at checkpoint {} -- resume from there?".format(
+                self.migration_name, status, checkpoint))
+
+        if checkpoint and resume:
+            echo("Resuming: {} from {}".format(self.migration_name, checkpoint))
+            self._run(checkpoint)
+        elif status == Migration.STATE_NEW or force:
+            self._run(None)
+        elif status == Migration.STATE_PROCESSING:
             echo("{} is currently being processed".format(self.migration_name))
-        elif self.status == Migration.STATE_COMPLETED:
+        elif status == Migration.STATE_COMPLETED:
             echo("{} has already been processed".format(self.migration_name))
-        elif self.status == Migration.STATE_FAILED:
+        elif status == Migration.STATE_FAILED:
             echo("{} has already been processed, and failed - best to restart".format(self.migration_name))
 
+    def _run(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.resumed_checkpoint = deepcopy(checkpoint)
+        if checkpoint is None and self.saved_checkpoint:
+            # starting over, an old checkpoint would only confuse the next resume
+            self.save_checkpoint(None)
+
+        self.update_status(Migration.STATE_PROCESSING)
+        echo("Starting: {}".format(self.migration_name))
+        self.telemetry = RunTelemetry().start()
+        try:
+            self.run()
+        except Exception:
+            echo("Migration {} Failed".format(self.migration_name))
+            typ, value, traceback = sys.exc_info()
+            echo("Unexpected error: [{}]".format(typ))
+            echo("Unexpected value: [{}]".format(value))
+            echo("Unexpected traceback: [{}]".format(traceback))
+            self.update_status(Migration.STATE_FAILED)
+            self.record_run(self.telemetry.finish())
+            raise
+        else:
+            telemetry = self.telemetry.finish()
+            echo("Migration {} Successful in {:.1f}s ({:.1f}s CPU, {} documents read, {} written)".format(
+                self.migration_name, telemetry['wall_seconds'], telemetry['cpu_seconds'],
+                telemetry['documents_read'], telemetry['documents_written']))
+            self.update_status(Migration.STATE_COMPLETED)
+            self.record_run(telemetry)
+            if self.checkpoint is not None:
+                self.save_checkpoint(None)
 
     def run(self):
         """Should be implemented by subclass"""
         raise NotImplementedError("This is an abstract class")
 
 
+DumpResult = namedtuple('DumpResult', ['collection_name', 'exit_code', 'seconds'])
+
+
+class DumpFailed(Exception):
+    """Raised when one or more collection dumps of a QuerySet did not succeed"""
+
+
+def _call_mongodump(execution_array, query=None):
+    """runs mongodump, handing it the query through a --queryFile so its size is not bound by the command line"""
+    echo("Executing: {}".format(execution_array))
+    if query is None:
+        return subprocess.call(execution_array)
+
+    fd, query_file = tempfile.mkstemp(suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            # extended json, so ObjectIds and dates survive the trip
+            f.write(json_util.dumps(query) if isinstance(query, dict) else str(query))
+        return subprocess.call(execution_array + ['--queryFile', query_file])
+    finally:
+        os.remove(query_file)
+
+
+def _run_dump(collection_name, execution_array, query=None):
+    started = time.time()
+    exit_code = _call_mongodump(execution_array, query)
+    return DumpResult(collection_name, exit_code, time.time() - started)
+
+
+def _run_dump_per_query(collection_name, execution_array, queries, dump_dir, db_name):
+    """mongodumps the collection once per query into a scratch directory, adding each part to dump_dir"""
+    started = time.time()
+    exit_code = 0
+    for number, query in enumerate(queries):
+        scratch_dir = tempfile.mkdtemp()
+        try:
+            exit_code = _call_mongodump(execution_array + ['-o', scratch_dir], query)
+            if exit_code != 0:
+                break
+            part_dir = os.path.join(scratch_dir, db_name)
+            with open(native.bson_path(dump_dir, collection_name), 'ab' if number else 'wb') as f:
+                if os.path.exists(native.bson_path(part_dir, collection_name)):
+                    with open(native.bson_path(part_dir, collection_name), 'rb') as part:
+                        # a .bson file is just documents one after the other, parts add up
+                        shutil.copyfileobj(part, f)
+            if os.path.exists(native.metadata_path(part_dir, collection_name)):
+                shutil.copy(native.metadata_path(part_dir, collection_name), dump_dir)
+        finally:
+            shutil.rmtree(scratch_dir)
+    return DumpResult(collection_name, exit_code, time.time() - started)
+
+
+def _run_native_dump(database, collection_name, dump_dir, query, batch_size, throttle=None):
+    echo("Dumping: {} {}".format(collection_name, query or ''))
+    return _run_native_dump_per_query(database, collection_name, dump_dir, [query], batch_size, throttle)
+
+
+def _run_native_dump_per_query(database, collection_name, dump_dir, queries, batch_size, throttle=None):
+    """dumps the documents matching each of the queries, one after the other, into the same file"""
+    started = time.time()
+    try:
+        for number, query in enumerate(queries):
+            native.dump_collection(database, collection_name, dump_dir, query=query, batch_size=batch_size,
+                                   throttle=throttle, append=number > 0)
+    except Exception as e:
+        echo("Dump of {} failed: [{}]".format(collection_name, e))
+        exit_code = 1
+    else:
+        exit_code = 0
+    return DumpResult(collection_name, exit_code, time.time() - started)
+
+
+def _run_staging(database, staging_database, collection_name, queries):
+    """copies the documents matching each query into the staging database, on the server, with $match + $merge"""
+    echo("Staging: {}".format(collection_name))
+    started = time.time()
+    try:
+        try:
+            # so the collection is dumped even if nothing matches
+            staging_database.create_collection(collection_name)
+        except CollectionInvalid:
+            # staged by an earlier call
+            pass
+        for query in queries:
+            database[collection_name].aggregate([
+                {'$match': query or {}},
+                {'$merge': {'into': {'db': staging_database.name, 'coll': collection_name},
+                            'whenMatched': 'keepExisting', 'whenNotMatched': 'insert'}},
+            ], allowDiskUse=True)
+    except Exception as e:
+        echo("Staging of {} failed: [{}]".format(collection_name, e))
+        exit_code = 1
+    else:
+        exit_code = 0
+    return DumpResult(collection_name, exit_code, time.time() - started)
+
+
 class QuerySet(object):
 
-    def __init__(self, database, mongodump_options):
+    # foreign keys dump_related follows, i.e. ['dog_houses.dog_id -> dogs._id'] -- see subsets.py
+    relationships = []
+    # how many _ids go in one $in query
+    in_batch_size = DEFAULT_IN_BATCH_SIZE
+
+    def __init__(self, database, mongodump_options, concurrency=1, engine='mongodump',
+                 batch_size=native.DEFAULT_BATCH_SIZE, throttle=None, staging_database=None):
         self.database = database
         self.mongodump_options = mongodump_options
         self.touched_collections = []
+        self.concurrency = concurrency
+        self.engine = engine
+        self.batch_size = batch_size
+        # only the native engine reads through monarch, mongodump can not be paced
+        self.throttle = throttle
+        # with a staging database the filters run on the server and the matching documents are merged into it, to
+        # be dumped all at once afterwards -- see mongo.dump_staged_query_set
+        self.staging_database = staging_database
+        self.dump_results = []
+        self._dump_pool = None
 
     @property
     def application_collection_names(self):
@@ -83,20 +321,95 @@ class QuerySet(object):
 
         return [col_name for col_name in self.database.collection_names() if not system_table_re.match(col_name)]
 
+    @property
+    def dump_dir(self):
+        """where the collection files land, mirroring mongodump's <out>/<db_name> layout"""
+        return os.path.join(self.mongodump_options['-o'], self.database.name)
+
     def dump_collection(self, collection_name, query=None):
         self.touched_collections.append(collection_name)
+
+        if self.staging_database is not None:
+            self.schedule_dump(_run_staging, self.database, self.staging_database, collection_name, [query])
+            return
+
+        if self.engine == 'native':
+            if not os.path.isdir(self.dump_dir):
+                os.makedirs(self.dump_dir)
+            self.schedule_dump(_run_native_dump, self.database, collection_name, self.dump_dir, query,
+                               self.batch_size, self.throttle)
+            return
+
+        self.schedule_dump(_run_dump, collection_name, self._mongodump_array(collection_name), query or None)
+
+    def _mongodump_array(self, collection_name, without=()):
         execution_array = ['mongodump']
 
         collection_options = copy(self.mongodump_options)
         collection_options['-c'] = collection_name
-
-        if query:
-            collection_options['-q'] = str(query)
+        for option in without:
+            collection_options.pop(option, None)
 
         for option in collection_options:
             execution_array.extend([option, collection_options[option]])
-        echo("Executing: {}".format(execution_array))
-        subprocess.call(execution_array)
+        return execution_array
+
+    def dump_ids(self, collection_name, ids):
+        """Dumps the documents of collection_name with the given _ids, `in_batch_size` of them per query
+
+        ids can be any iterable, an IdSet (see subsets.py) keeps large ones small.
+        """
+        self.touched_collections.append(collection_name)
+        queries = in_queries('_id', ids, self.in_batch_size)
+
+        if self.staging_database is not None:
+            self.schedule_dump(_run_staging, self.database, self.staging_database, collection_name, queries)
+            return
+
+        if not os.path.isdir(self.dump_dir):
+            os.makedirs(self.dump_dir)
+        if self.engine == 'native':
+            self.schedule_dump(_run_native_dump_per_query, self.database, collection_name, self.dump_dir, queries,
+                               self.batch_size, self.throttle)
+        else:
+            self.schedule_dump(_run_dump_per_query, collection_name, self._mongodump_array(collection_name, ['-o']),
+                               queries, self.dump_dir, self.database.name)
+
+    def dump_related(self, collection_name, query=None):
+        """Dumps the documents of collection_name matching query and every document related to them
+
+        Related means linked through self.relationships, followed down to what refers to them and up to what they
+        refer to -- see subsets.py.  Returns {collection name: IdSet of the _ids dumped}.
+        """
+        selected = related_ids(self.database, self.relationships, collection_name, query, self.in_batch_size)
+        for name, ids in selected.items():
+            self.dump_ids(name, ids)
+        return selected
+
+    def schedule_dump(self, dump_function, *args):
+        """queues a dump on the worker pool, at most `concurrency` of them run at once.
+        dump_function should return a DumpResult"""
+        if self._dump_pool is None:
+            self._dump_pool = WorkerPool(self.concurrency)
+        self._dump_pool.submit(dump_function, *args)
+
+    def wait_for_dumps(self):
+        """waits for every scheduled dump, raises DumpFailed if any of them did not exit cleanly"""
+        if self._dump_pool is None:
+            return self.dump_results
+
+        dump_pool, self._dump_pool = self._dump_pool, None
+        results = dump_pool.join()
+        self.dump_results.extend(results)
+
+        for result in results:
+            echo("{:40} exit code {} in {:.1f}s".format(result.collection_name, result.exit_code, result.seconds))
+
+        failed = [result.collection_name for result in results if result.exit_code != 0]
+        if failed:
+            raise DumpFailed("Dumps failed for: {}".format(", ".join(failed)))
+
+        return self.dump_results
 
     def run(self):
         """Should be implemented by the subclass"""
@@ -127,6 +440,8 @@ class QuerySet(object):
         for collection_name in self.additional_collections:
             self.dump_collection(collection_name)
 
+        return self.wait_for_dumps()
+
 
 class MigrationHistoryStorage(object):
     """Contract for persistence implementations to adhere to"""
@@ -142,3 +457,9 @@ class MigrationHistory(object):
         self.key = kwargs.get('key')
         self.state = kwargs.get('state')
         self.processed_at = kwargs.get('processed_at')
+        self.started_at = kwargs.get('started_at')
+        self.wall_seconds = kwargs.get('wall_seconds')
+        self.cpu_seconds = kwargs.get('cpu_seconds')
+        self.peak_rss_bytes = kwargs.get('peak_rss_bytes')
+        self.documents_read = kwargs.get('documents_read')
+        self.documents_written = kwargs.get('documents_written')
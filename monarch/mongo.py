@@ -1,43 +1,40 @@
+import os
+import time
+import uuid
+import threading
 import subprocess
 from tempfile import mkdtemp
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from collections import deque
 
 import click
 import pymongo
 import mongoengine
 from click import echo
 
-from .utils import temp_directory
+from . import native
+from .utils import temp_directory, WorkerPool
+from .lease import RUNNER_ID, Heartbeat, LeaseLost
+from .connections import client_for, connect_documents, dump_database, read_preference
 from .models import Migration, MigrationHistoryStorage
 from .query_sets import querysets
+from .throttle import throttle_for, wait_for_secondaries
 
+DUMP_ENGINES = ('mongodump', 'native')
+# how query sets dump: each collection on its own with its filter, or staged server side and dumped in one pass
+QUERY_SET_MODES = ('direct', 'staged')
+RESTORE_ENGINES = ('mongorestore', 'native')
+# how a restore replaces what is there: drop the database then load it, or load beside it and swap the data in
+RESTORE_MODES = ('replace', 'swap')
+SWAP_PREFIX = '_monarch_swap_'
 
-def establish_datastore_connection(environment):
-    mongo_db_name = environment['db_name']
-
-    username_password_couple = ""
-    if 'username' in environment:
-        if 'password' in environment:
-            username_password_couple = "{}:{}@".format(environment['username'], environment['password'])
-        else:
-            username_password_couple = "{}@".format(environment['username'])
-
-    if 'port' in environment:
-        raise Exception("port no longer supported, use the host:port syntax in the host parameter")
-
-    host_and_port = environment['host']
-
-    db_name = "/{}".format(environment['db_name'])
-
-    uri = "mongodb://{username_password_couple}{host_and_port}{db_name}".format(username_password_couple=username_password_couple,
-                                                                                host_and_port=host_and_port,
-                                                                                db_name=db_name)
-
-    if 'sslCAFile' in environment:
-        echo('appending ssl')
-        uri = "{}?ssl=true&ssl_ca_certs={}".format(uri, environment['sslCAFile'])
 
-    echo('executing: {}'.format(uri))
-    return mongoengine.connect(mongo_db_name, host=uri)
+def establish_datastore_connection(environment):
+    """binds mongoengine to environment and returns its pooled MongoClient, see connections.py"""
+    client = connect_documents(environment)
+    MongoMigrationHistory.ensure_unique_keys()
+    return client
 
 
 class MongoMigrationHistory(MigrationHistoryStorage, mongoengine.Document):
@@ -47,38 +44,457 @@ class MongoMigrationHistory(MigrationHistoryStorage, mongoengine.Document):
     key = mongoengine.StringField()
     state = mongoengine.StringField(default=Migration.STATE_NEW)
     processed_at = mongoengine.DateTimeField()
+    # how far a long migration got, see Migration.save_checkpoint
+    checkpoint = mongoengine.DictField(null=True)
+    # what the last run cost, see telemetry.py -- processed_at is when it ended
+    started_at = mongoengine.DateTimeField()
+    wall_seconds = mongoengine.FloatField()
+    cpu_seconds = mongoengine.FloatField()
+    peak_rss_bytes = mongoengine.IntField()
+    documents_read = mongoengine.IntField()
+    documents_written = mongoengine.IntField()
+    # the runner holding the migration and until when, see lease.py
+    owner = mongoengine.StringField()
+    lease_expires_at = mongoengine.DateTimeField()
+
+    meta = {
+        'indexes': [{'fields': ['key'], 'unique': True}],
+        # created by ensure_unique_keys, which first merges the duplicates older versions could leave behind
+        'auto_create_index': False,
+    }
+
+    # which record of a duplicated key to keep, the one furthest along
+    STATE_RANKS = {Migration.STATE_COMPLETED: 3, Migration.STATE_PROCESSING: 2, Migration.STATE_FAILED: 1,
+                   Migration.STATE_NEW: 0}
+
+    @classmethod
+    def ensure_unique_keys(cls):
+        """Creates the unique index on key
+
+        Before it, creating records was not atomic and a key could end up with several.  Of those the one furthest
+        along, the last processed if several are, is kept and the others removed -- the index could not be created
+        otherwise.
+        """
+        collection = cls._get_collection()
+        duplicates = collection.aggregate([
+            {'$group': {'_id': '$key', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+        ])
+        for duplicate in duplicates:
+            records = sorted(collection.find({'_id': {'$in': duplicate['ids']}}), reverse=True,
+                             key=lambda record: (cls.STATE_RANKS.get(record.get('state'), -1),
+                                                 record.get('processed_at') or datetime.min))
+            collection.delete_many({'_id': {'$in': [record['_id'] for record in records[1:]]}})
+            echo("{} had {} history records, kept the {} one".format(duplicate['_id'], len(records),
+                                                                      records[0].get('state')))
+        cls.ensure_indexes()
 
     @classmethod
     def find_or_create_by_key(cls, migration_key):
-        result = cls.objects(key=migration_key)
-        if len(result) == 1:
-            return result[0]
-        else:
-            return cls(key=migration_key).save()
+        # one atomic upsert, the unique index on key keeps concurrent callers from creating duplicates
+        return cls.objects(key=migration_key).modify(upsert=True, new=True,
+                                                     set_on_insert__state=Migration.STATE_NEW)
 
     @classmethod
     def find_by_key(cls, migration_key):
-        results = cls.objects(key=migration_key)
-        if len(results) == 1:
-            return results[0]
-        else:
+        return cls.objects(key=migration_key).first()
+
+    @classmethod
+    def _owned_by(cls, migration_key, owner):
+        """the record of migration_key, upserted -- or with owner given, only while owner holds its lease"""
+        if owner is None:
+            return cls.objects(key=migration_key), {'upsert': True}
+        return cls.objects(key=migration_key, owner=owner), {}
+
+    @classmethod
+    def update_state_by_key(cls, migration_key, state, owner=None):
+        """sets the state, returns None if owner is given and no longer holds the lease"""
+        records, options = cls._owned_by(migration_key, owner)
+        return records.modify(new=True, set__state=state, **options)
+
+    @classmethod
+    def save_checkpoint_by_key(cls, migration_key, checkpoint, owner=None):
+        records, options = cls._owned_by(migration_key, owner)
+        if checkpoint is None:
+            return records.modify(new=True, unset__checkpoint=True, **options)
+        return records.modify(new=True, set__checkpoint=checkpoint, **options)
+
+    @classmethod
+    def claim_by_key(cls, migration_key, owner, lease_seconds):
+        """Takes the lease on a migration nobody holds a live lease on, returns its record or None if it is taken
+
+        One findAndModify, so of the runners claiming the same migration only one gets it.  A migration left
+        Processing by a runner whose lease ran out is marked Failed.
+        """
+        now = datetime.utcnow()
+        free = mongoengine.Q(lease_expires_at=None) | mongoengine.Q(lease_expires_at__lt=now)
+        try:
+            previous = cls.objects(mongoengine.Q(key=migration_key) & free).modify(
+                upsert=True, new=False, set__owner=owner,
+                set__lease_expires_at=now + timedelta(seconds=lease_seconds),
+                set_on_insert__state=Migration.STATE_NEW)
+        except mongoengine.NotUniqueError:
+            # someone holds it, so the upsert tried to add a second record for the key
             return None
 
+        if previous is not None and previous.state == Migration.STATE_PROCESSING and previous.owner:
+            echo("{} was left Processing by {} whose lease ran out".format(migration_key, previous.owner))
+            return cls.update_state_by_key(migration_key, Migration.STATE_FAILED)
+        return cls.find_by_key(migration_key)
+
+    @classmethod
+    def renew_lease_by_key(cls, migration_key, owner, lease_seconds):
+        """pushes the lease expiry forward, returns None if owner no longer holds the lease"""
+        return cls.objects(key=migration_key, owner=owner).modify(
+            new=True, set__lease_expires_at=datetime.utcnow() + timedelta(seconds=lease_seconds))
+
+    @classmethod
+    def release_lease_by_key(cls, migration_key, owner):
+        return cls.objects(key=migration_key, owner=owner).modify(new=True, unset__owner=True,
+                                                                  unset__lease_expires_at=True)
+
+    @classmethod
+    def record_run_by_key(cls, migration_key, telemetry, owner=None):
+        records, options = cls._owned_by(migration_key, owner)
+        updates = dict(('set__{}'.format(field), value) for field, value in telemetry.items() if value is not None)
+        updates.update(options)
+        return records.modify(new=True, **updates)
+
     @classmethod
     def all(cls):
         return cls.objects()
 
 
+class MongoMigrationHistoryCache(object):
+    """Every MongoMigrationHistory record, loaded in one query and kept current as migrations change state
+
+    Share one between the migrations of a run so checking their status costs a single round trip.
+    """
+
+    def __init__(self):
+        self._records = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._records is None:
+            self._records = dict((record.key, record) for record in MongoMigrationHistory.all())
+        return self._records
+
+    def find_by_key(self, migration_key):
+        with self._lock:
+            return self._load().get(migration_key)
+
+    def find_or_create_by_key(self, migration_key):
+        with self._lock:
+            records = self._load()
+            if migration_key not in records:
+                records[migration_key] = MongoMigrationHistory.find_or_create_by_key(migration_key)
+            return records[migration_key]
+
+    def _keep(self, migration_key, record):
+        # None when a fenced write found another owner, what is cached is as good as anything then
+        if record is not None:
+            with self._lock:
+                self._load()[migration_key] = record
+        return record
+
+    def update_state(self, migration_key, state, owner=None):
+        return self._keep(migration_key, MongoMigrationHistory.update_state_by_key(migration_key, state, owner))
+
+    def save_checkpoint(self, migration_key, checkpoint, owner=None):
+        return self._keep(migration_key,
+                          MongoMigrationHistory.save_checkpoint_by_key(migration_key, checkpoint, owner))
+
+    def record_run(self, migration_key, telemetry, owner=None):
+        return self._keep(migration_key, MongoMigrationHistory.record_run_by_key(migration_key, telemetry, owner))
+
+    def claim(self, migration_key, owner, lease_seconds):
+        # the record comes back fresh, another runner may have moved the migration on since it was cached
+        record = MongoMigrationHistory.claim_by_key(migration_key, owner, lease_seconds)
+        if record is not None:
+            with self._lock:
+                self._load()[migration_key] = record
+        return record
+
+    def renew_lease(self, migration_key, owner, lease_seconds):
+        return MongoMigrationHistory.renew_lease_by_key(migration_key, owner, lease_seconds)
+
+    def release_lease(self, migration_key, owner):
+        return MongoMigrationHistory.release_lease_by_key(migration_key, owner)
+
+
+DEFAULT_MIGRATION_BATCH_SIZE = 1000
+BATCH_COUNTS = ('documents', 'matched', 'modified', 'inserted', 'upserted', 'deleted')
+
+
+def _writes_for(batch, transform, batch_transform):
+    if batch_transform is not None:
+        return list(batch_transform(batch) or [])
+
+    writes = []
+    for document in batch:
+        result = transform(document)
+        if result is None:
+            continue
+        if isinstance(result, (list, tuple)):
+            writes.extend(result)
+        else:
+            writes.append(result)
+    return writes
+
+
+def write_batch(collection, batch, transform=None, batch_transform=None):
+    """turns a batch of documents into writes and sends them in one unordered bulk_write, returns the counts"""
+    writes = _writes_for(batch, transform, batch_transform)
+    counts = dict.fromkeys(BATCH_COUNTS, 0)
+    counts['documents'] = len(batch)
+    if writes:
+        result = collection.bulk_write(writes, ordered=False)
+        counts.update(matched=result.matched_count, modified=result.modified_count,
+                      inserted=result.inserted_count, upserted=result.upserted_count,
+                      deleted=result.deleted_count)
+    return counts
+
+
 class MongoBackedMigration(Migration):
 
+    def __init__(self, history=None, throttle=None):
+        super(MongoBackedMigration, self).__init__(history or MongoMigrationHistoryCache(), throttle=throttle)
+        # process_in_batches calls of this run, by checkpoint name
+        self._batch_passes = {}
+        # while the migration is claimed: who holds it, and the heartbeat keeping the lease alive
+        self._owner = None
+        self._heartbeat = None
+
+    def check_lease(self):
+        """raises LeaseLost once another runner took the migration over, see lease.py"""
+        if self._heartbeat is not None and self._heartbeat.lost:
+            raise LeaseLost("{} was taken over by another runner after its lease ran out".format(
+                self.migration_name))
+
+    def _fenced(self, record):
+        if record is None:
+            raise LeaseLost("{} was taken over by another runner after its lease ran out".format(
+                self.migration_name))
+        return record
+
     def update_status(self, state):
-        migration_meta = MongoMigrationHistory.find_or_create_by_key(self.migration_key)
-        migration_meta.update(set__state=state)
+        self.check_lease()
+        self._fenced(self.history.update_state(self.migration_key, state, owner=self._owner))
 
     @property
     def status(self):
-        migration_meta = MongoMigrationHistory.find_or_create_by_key(self.migration_key)
-        return migration_meta.state
+        return self.history.find_or_create_by_key(self.migration_key).state
+
+    def save_checkpoint(self, checkpoint):
+        self.check_lease()
+        self.checkpoint = checkpoint
+        self._fenced(self.history.save_checkpoint(self.migration_key, checkpoint, owner=self._owner))
+
+    @property
+    def saved_checkpoint(self):
+        return self.history.find_or_create_by_key(self.migration_key).checkpoint or None
+
+    def record_run(self, telemetry):
+        # the figures of a run that lost its lease are dropped, not raised about
+        self.history.record_run(self.migration_key, telemetry, owner=self._owner)
+
+    @contextmanager
+    def claimed(self):
+        """claims the migration in the history and keeps the lease alive with a heartbeat, see lease.py"""
+        if self.history.claim(self.migration_key, RUNNER_ID, self.lease_seconds) is None:
+            yield False
+            return
+
+        def renew():
+            return self.history.renew_lease(self.migration_key, RUNNER_ID, self.lease_seconds) is not None
+
+        heartbeat = Heartbeat(renew, self.lease_seconds / 3.0, label=self.migration_name).start()
+        self._owner, self._heartbeat = RUNNER_ID, heartbeat
+        try:
+            yield True
+        finally:
+            heartbeat.stop()
+            self._owner, self._heartbeat = None, None
+            self.history.release_lease(self.migration_key, RUNNER_ID)
+
+    @property
+    def database(self):
+        """the pymongo Database of the environment being migrated"""
+        return mongoengine.connection.get_db()
+
+    def _run(self, checkpoint):
+        self._batch_passes = {}
+        super(MongoBackedMigration, self)._run(checkpoint)
+
+    def _pass_name(self, checkpoint_name):
+        """checkpoint_name for the first pass over it in this run, then 'name#2', 'name#3' ..."""
+        passes = self._batch_passes.get(checkpoint_name, 0) + 1
+        self._batch_passes[checkpoint_name] = passes
+        return checkpoint_name if passes == 1 else '{}#{}'.format(checkpoint_name, passes)
+
+    def batch_progress(self, checkpoint_name):
+        """what the run this one resumed from got through under checkpoint_name, or None"""
+        for progress in (self.resumed_checkpoint or {}).get('batches', []):
+            if progress['name'] == checkpoint_name:
+                return progress
+        return None
+
+    def save_batch_progress(self, checkpoint_name, **progress):
+        checkpoint = dict(self.checkpoint or {})
+        batches = [entry for entry in checkpoint.get('batches', []) if entry['name'] != checkpoint_name]
+        batches.append(dict(progress, name=checkpoint_name))
+        checkpoint['batches'] = batches
+        self.save_checkpoint(checkpoint)
+
+    def process_in_batches(self, collection, transform=None, query=None, batch_transform=None, projection=None,
+                           batch_size=DEFAULT_MIGRATION_BATCH_SIZE, workers=1, label=None, checkpoint_name=None,
+                           count=False):
+        """Runs every document of collection matching query through transform, and writes the results back in bulk
+
+        collection is a name or a pymongo Collection.  transform(document) returns a pymongo write -- UpdateOne,
+        ReplaceOne, DeleteOne, InsertOne ... -- a list of them, or None to leave the document alone.  Or give
+        batch_transform(documents), returning the writes for a whole batch.
+
+        Documents are read in _id order, `batch_size` at a time, from a cursor that does not time out.  The writes of
+        each batch go out as one unordered bulk_write, up to `workers` batches at once, paced by self.throttle if
+        there is one, and a progressbar follows along.  Returns the totals: documents, matched, modified, inserted,
+        upserted and deleted.
+
+        The progressbar is sized from the collection's metadata (estimated_document_count), which with a query is
+        only an upper bound.  count=True counts the matching documents first for an exact bar -- a scan of the
+        collection unless the query is indexed.
+
+        After every batch the highest _id written so far is saved as a checkpoint under checkpoint_name (the
+        collection name unless given, numbered from the second pass over it in a run on), and a resumed run starts
+        after it.  Only batches written in full, with every batch before them written too, count.
+        """
+        if (transform is None) == (batch_transform is None):
+            raise Exception("process_in_batches needs either a transform or a batch_transform")
+
+        if not isinstance(collection, pymongo.collection.Collection):
+            collection = self.database[collection]
+        checkpoint_name = self._pass_name(checkpoint_name or collection.name)
+        query = query or {}
+
+        totals = dict.fromkeys(BATCH_COUNTS, 0)
+
+        progress = self.batch_progress(checkpoint_name) or {'last_id': None, 'documents': 0, 'done': False}
+        if progress['done']:
+            echo("{} was already processed before resuming, skipping it".format(checkpoint_name))
+            return totals
+        if progress['last_id'] is not None:
+            query = {'$and': [query, {'_id': {'$gt': progress['last_id']}}]}
+
+        # batches in flight, in the order they were read: (AsyncResult, last _id of the batch, documents in it)
+        in_flight = deque()
+
+        def record_finished_batches(wait=False):
+            while in_flight and (wait or in_flight[0][0].ready()):
+                result, last_id, documents = in_flight.popleft()
+                counts = result.get()
+                for name in BATCH_COUNTS:
+                    totals[name] += counts[name]
+                self.count_documents(read=counts['documents'],
+                                     written=counts['modified'] + counts['inserted'] + counts['upserted'] +
+                                     counts['deleted'])
+                progress.update(last_id=last_id, documents=progress['documents'] + documents)
+                self.save_batch_progress(checkpoint_name, **progress)
+
+        def submit(pool, batch):
+            # a runner that lost its lease stops before writing another batch
+            self.check_lease()
+            if self.throttle is not None:
+                self.throttle.wait()
+            result = pool.submit(write_batch, collection, batch, transform, batch_transform)
+            in_flight.append((result, batch[-1]['_id'], len(batch)))
+            record_finished_batches()
+
+        if count:
+            if self.throttle is not None:
+                self.throttle.wait()
+            length = collection.count_documents(query)
+        else:
+            length = max(0, collection.estimated_document_count() - progress['documents'])
+
+        cursor = collection.find(query, projection, no_cursor_timeout=True, batch_size=batch_size).sort('_id', 1)
+        try:
+            with click.progressbar(length=length,
+                                   label=label or 'Processing {}'.format(collection.name)) as bar:
+                with WorkerPool(workers) as pool:
+                    batch = []
+                    for document in cursor:
+                        batch.append(document)
+                        if len(batch) >= batch_size:
+                            submit(pool, batch)
+                            bar.update(len(batch))
+                            batch = []
+                    if batch:
+                        submit(pool, batch)
+                        bar.update(len(batch))
+
+                    # in order, so a failed batch raises once the ones before it are checkpointed
+                    record_finished_batches(wait=True)
+                    pool.join()
+        finally:
+            cursor.close()
+
+        progress['done'] = True
+        self.save_batch_progress(checkpoint_name, **progress)
+        return totals
+
+
+def _tool_execution_array(tool, environment, options):
+    """builds the argv for a mongo tool (mongodump / mongorestore) against the given environment"""
+    options = dict(options)
+    options['-h'] = environment['host']
+
+    if 'username' in environment:
+        options['-u'] = environment['username']
+
+    if 'password' in environment:
+        options['-p'] = environment['password']
+
+    execution_array = [tool]
+
+    if 'sslCAFile' in environment:
+        execution_array.append('--ssl')
+        execution_array.extend(['--sslCAFile', environment['sslCAFile']])
+
+    for option in options:
+        execution_array.extend([option, options[option]])
+
+    return execution_array
+
+
+def _dump_execution_array(environment, options):
+    """the mongodump argv for environment, reading with its read_preference"""
+    options = dict(options)
+    if read_preference(environment) is not None:
+        options['--readPreference'] = read_preference(environment)
+    return _tool_execution_array('mongodump', environment, options)
+
+
+def dump_engine(environment):
+    """which engine dumps this environment -- set 'dump_engine' in ENVIRONMENTS to 'native' to skip mongodump"""
+    engine = environment.get('dump_engine', 'mongodump')
+    if engine not in DUMP_ENGINES:
+        raise Exception("dump_engine must be one of {}, got {}".format(", ".join(DUMP_ENGINES), engine))
+    return engine
+
+
+def query_set_mode(environment):
+    """how query sets run against this environment -- set 'query_set_mode' in ENVIRONMENTS to 'staged' to filter
+    on the server, see dump_staged_query_set"""
+    mode = environment.get('query_set_mode', 'direct')
+    if mode not in QUERY_SET_MODES:
+        raise Exception("query_set_mode must be one of {}, got {}".format(", ".join(QUERY_SET_MODES), mode))
+    return mode
+
+
+def staging_database_name(db_name):
+    # database names are limited to 64 characters
+    return '{}_staging_{}'.format(db_name[:40], uuid.uuid4().hex[:8])
 
 
 def dump_db(from_env, **kwargs):
@@ -89,8 +505,8 @@ def dump_db(from_env, **kwargs):
     else:
         temp_dir = mkdtemp()
 
-    if 'QuerySet' in kwargs:
-        QuerySet = kwargs['QuerySet']
+    QuerySet = kwargs.get('QuerySet')
+    engine = dump_engine(from_env)
 
     echo("env: {}".format(from_env))
 
@@ -103,25 +519,50 @@ def dump_db(from_env, **kwargs):
         options['-u'] = from_env['username']
     if 'password' in from_env:
         options['-p'] = from_env['password']
+    if read_preference(from_env) is not None:
+        # query sets run mongodump with these options too
+        options['--readPreference'] = read_preference(from_env)
 
     if QuerySet:
         echo("In Query Set: Env: {}".format(from_env))
-        connection = establish_datastore_connection(from_env)
-        database = connection[from_env['db_name']]
-
-        query_set = QuerySet(database, options)
-
-        query_set.execute()
+        connection = client_for(from_env)
+        database = dump_database(connection[from_env['db_name']], from_env)
+
+        throttle = throttle_for(from_env, connection, label='dump')
+        staging_database = None
+        if query_set_mode(from_env) == 'staged':
+            staging_database = connection[staging_database_name(from_env['db_name'])]
+            echo("Staging the query set in {}".format(staging_database.name))
+
+        query_set = QuerySet(database, options,
+                             concurrency=from_env.get('dump_concurrency', 1),
+                             engine=engine,
+                             batch_size=from_env.get('dump_batch_size', native.DEFAULT_BATCH_SIZE),
+                             throttle=throttle,
+                             staging_database=staging_database)
+
+        try:
+            query_set.execute()
+            if staging_database is not None:
+                # the staging database was just written on the primary, read it elsewhere once it got there
+                staged_env = from_env
+                if read_preference(from_env) not in (None, 'primary') and not wait_for_secondaries(connection):
+                    echo("The secondaries did not catch up with {}, dumping it from the primary".format(
+                        staging_database.name))
+                    staged_env = dict(from_env, read_preference='primary')
+                dump_staged_query_set(staged_env, database, staging_database, temp_dir, engine, throttle)
+        finally:
+            if staging_database is not None:
+                connection.drop_database(staging_database.name)
+        if throttle is not None:
+            throttle.report()
+
+    elif engine == 'native':
+        dump_db_natively(from_env, temp_dir)
 
     else:
 
-        execution_array = ['mongodump']
-        if 'sslCAFile' in from_env:
-            execution_array.append('--ssl')
-            execution_array.extend(['--sslCAFile', from_env['sslCAFile']])
-
-        for option in options:
-            execution_array.extend([option, options[option]])
+        execution_array = _dump_execution_array(from_env, options)
         echo("Executing: {}".format(execution_array))
         subprocess.call(execution_array)
 
@@ -130,62 +571,285 @@ def dump_db(from_env, **kwargs):
     return dump_path
 
 
-def copy_db(from_env, to_env, query_set=None):
+def dump_staged_query_set(from_env, database, staging_database, temp_dir, engine, throttle=None):
+    """Dumps the staging database a query set filled in one pass, laid out as a dump of database
+
+    The staged collections have none of the indexes or options of the originals, their metadata is taken from
+    database instead.  They are read with the read_preference of from_env.
+    """
+    if engine == 'native':
+        dump_collections_natively(dump_database(staging_database, from_env),
+                                  os.path.join(temp_dir, staging_database.name),
+                                  concurrency=from_env.get('dump_concurrency', 1),
+                                  batch_size=from_env.get('dump_batch_size', native.DEFAULT_BATCH_SIZE),
+                                  throttle=throttle)
+    else:
+        options = {'-d': staging_database.name, '-o': temp_dir}
+        if 'username' in from_env:
+            # the user is defined on the application database, not the staging one
+            options['--authenticationDatabase'] = from_env['db_name']
+        execution_array = _dump_execution_array(from_env, options)
+        echo("Executing: {}".format(execution_array))
+        if subprocess.call(execution_array) != 0:
+            raise Exception("mongodump of the staging database {} failed".format(staging_database.name))
+
+    dump_dir = os.path.join(temp_dir, database.name)
+    os.rename(os.path.join(temp_dir, staging_database.name), dump_dir)
+    for collection_name in native.collection_names_of(os.listdir(dump_dir)):
+        native.write_metadata(database[collection_name], dump_dir)
+
+
+def dump_db_natively(from_env, temp_dir):
+    """dumps every application collection over pymongo, `dump_concurrency` collections at a time"""
+    connection = client_for(from_env)
+    database = dump_database(connection[from_env['db_name']], from_env)
+
+    throttle = throttle_for(from_env, connection, label='dump')
+    dump_collections_natively(database, os.path.join(temp_dir, from_env['db_name']),
+                              concurrency=from_env.get('dump_concurrency', 1),
+                              batch_size=from_env.get('dump_batch_size', native.DEFAULT_BATCH_SIZE),
+                              throttle=throttle)
+    if throttle is not None:
+        throttle.report()
+
+
+def dump_collections_natively(database, dump_dir, concurrency=1, batch_size=native.DEFAULT_BATCH_SIZE, throttle=None):
+    """dumps every application collection of database into dump_dir, `concurrency` collections at a time"""
+    if not os.path.isdir(dump_dir):
+        os.makedirs(dump_dir)
+
+    def dump(collection_name):
+        started = time.time()
+        bytes_written = native.dump_collection(database, collection_name, dump_dir, batch_size=batch_size,
+                                               throttle=throttle)
+        echo("{:40} {} bytes in {:.1f}s".format(collection_name, bytes_written, time.time() - started))
+
+    with WorkerPool(concurrency) as pool:
+        for collection_name in native.application_collection_names(database):
+            pool.submit(dump, collection_name)
+        pool.join()
+
+
+def copy_db(from_env, to_env, query_set=None, stream=False, skip_indexes=False):
+    if stream:
+        if query_set:
+            raise Exception("streaming copies do not support query sets, drop the query set or the stream option")
+        stream_db(from_env, to_env)
+        return
+
     with temp_directory() as temp_dir:
         dump_path = dump_db(from_env, temp_dir=temp_dir, QuerySet=query_set)
-        restore(dump_path, to_env)
+        restore(dump_path, to_env, skip_indexes=skip_indexes)
+
+
+def stream_db(from_env, to_env):
+    """Pipes a mongodump archive of from_env straight into mongorestore for to_env
 
+    Both tools run at the same time, so documents land in the target while the source is still being read,
+    and nothing is written to local disk.
+    """
+    if restore_mode(to_env) == 'swap':
+        restore_with_swap(to_env, lambda prefix: _stream(from_env, to_env, prefix))
+        return
 
-def restore(dump_path, to_env):
     drop(to_env)
+    _stream(from_env, to_env)
+
+
+def _stream(from_env, to_env, collection_prefix=''):
+    dump_array = _dump_execution_array(from_env, {'-d': from_env['db_name']})
+    dump_array.append('--archive')
+
+    # the archive carries the source namespaces, so rename them on the way in
+    restore_array = _tool_execution_array('mongorestore', to_env, {
+        '--nsFrom': '{}.*'.format(from_env['db_name']),
+        '--nsTo': '{}.{}*'.format(to_env['db_name'], collection_prefix),
+    })
+    restore_array.append('--archive')
+
+    echo("Executing: {} | {}".format(dump_array, restore_array))
+    dumper = subprocess.Popen(dump_array, stdout=subprocess.PIPE)
+    restorer = subprocess.Popen(restore_array, stdin=dumper.stdout)
+
+    # let mongodump see a broken pipe if mongorestore goes away
+    dumper.stdout.close()
+
+    restore_code = restorer.wait()
+    dump_code = dumper.wait()
+
+    if dump_code != 0 or restore_code != 0:
+        raise Exception("streaming copy failed: mongodump exited with {}, mongorestore exited with {}".format(
+            dump_code, restore_code))
+
+
+def restore_engine(environment):
+    """which engine restores into this environment -- set 'restore_engine' in ENVIRONMENTS to 'native' to skip
+    mongorestore"""
+    engine = environment.get('restore_engine', 'mongorestore')
+    if engine not in RESTORE_ENGINES:
+        raise Exception("restore_engine must be one of {}, got {}".format(", ".join(RESTORE_ENGINES), engine))
+    return engine
+
+
+def restore_mode(environment):
+    """how a restore replaces the data of this environment -- set 'restore_mode' in ENVIRONMENTS to 'swap' to keep
+    it up while the restore runs, see restore_with_swap"""
+    mode = environment.get('restore_mode', 'replace')
+    if mode not in RESTORE_MODES:
+        raise Exception("restore_mode must be one of {}, got {}".format(", ".join(RESTORE_MODES), mode))
+    return mode
+
+
+def restore(dump_path, to_env, skip_indexes=False):
+    """restores a mongodump style directory into to_env, skip_indexes leaves out every index but _id"""
+    if restore_mode(to_env) == 'swap':
+        restore_with_swap(to_env, lambda prefix: _restore_directory(dump_path, to_env, skip_indexes, prefix))
+        return
+
+    drop(to_env)
+    _restore_directory(dump_path, to_env, skip_indexes)
+
+
+def _restore_directory(dump_path, to_env, skip_indexes=False, collection_prefix=''):
+    if restore_engine(to_env) == 'native':
+        restore_natively(native.DirectoryDump(dump_path), to_env, skip_indexes, collection_prefix)
+        return
 
     options = {
-        '-h': to_env['host'],
         '-d': to_env['db_name'],
     }
 
-    if 'username' in to_env:
-        options['-u'] = to_env['username']
+    # the database was just dropped, or the collections are new, so no --drop
+    execution_array = _tool_execution_array('mongorestore', to_env, options)
+    if skip_indexes:
+        execution_array.insert(1, '--noIndexRestore')
+    if collection_prefix:
+        execution_array.extend(['--nsFrom', '{}.*'.format(to_env['db_name']),
+                                '--nsTo', '{}.{}*'.format(to_env['db_name'], collection_prefix)])
+    execution_array.append(dump_path)
 
-    if 'password' in to_env:
-        options['-p'] = to_env['password']
+    echo("Executing: {}".format(execution_array))
+    exit_code = subprocess.call(execution_array)
+    if exit_code != 0:
+        raise Exception("mongorestore into {} failed with exit code {}".format(to_env['db_name'], exit_code))
 
-    execution_array = ['mongorestore', '--drop']
 
-    if 'sslCAFile' in to_env:
-        execution_array.append('--ssl')
-        execution_array.extend(['--sslCAFile', to_env['sslCAFile']])
+def restore_with_swap(to_env, load):
+    """Restores beside the live collections of to_env, then swaps the restored ones in
 
-    for option in options:
-        execution_array.extend([option, options[option]])
+    load(prefix) restores the dump into collections named prefix + collection name, in the same database.  Only
+    once it has loaded everything and built the indexes is each one renamed over its live counterpart with
+    renameCollection and dropTarget, a metadata change that takes moments.  Live collections the dump does not have
+    are dropped afterwards.  If the load fails the live data is left as it was, and the half restored collections
+    are dropped either way.
+    """
+    connection = client_for(to_env)
+    database = connection[to_env['db_name']]
+    prefix = '{}{}_'.format(SWAP_PREFIX, uuid.uuid4().hex[:8])
 
-    execution_array.append(dump_path)
+    echo()
+    echo("You are about to restore {} beside its live collections and swap them in when done".format(database.name))
+    echo()
+    click.confirm('ARE YOU SURE??', abort=True)
 
-    echo("Executing: {}".format(execution_array))
-    subprocess.call(execution_array)
+    try:
+        load(prefix)
+        swap_collections(database, prefix)
+    finally:
+        for collection_name in database.list_collection_names():
+            if collection_name.startswith(prefix):
+                database.drop_collection(collection_name)
 
 
-def drop(environ):
+def swap_collections(database, prefix):
+    """renames every prefix + name collection of database over name, then drops the collections it did not replace"""
+    staged = [name for name in database.list_collection_names() if name.startswith(prefix)]
+    restored = set(name[len(prefix):] for name in staged)
 
-    options = {
-        '--eval': '"db.dropDatabase()"'
-    }
+    started = time.time()
+    for staged_name in staged:
+        database.client.admin.command('renameCollection', '{}.{}'.format(database.name, staged_name),
+                                      to='{}.{}'.format(database.name, staged_name[len(prefix):]),
+                                      dropTarget=True)
 
-    database_string = "{}/{}".format(environ['host'], environ['db_name'])
+    for collection_name in native.application_collection_names(database):
+        # leave other restores that are still loading alone
+        if collection_name not in restored and not collection_name.startswith(SWAP_PREFIX):
+            database.drop_collection(collection_name)
+    echo("Swapped {} collections into {} in {:.1f}s".format(len(staged), database.name, time.time() - started))
 
-    execution_array = ['mongo', database_string]
 
-    if 'sslCAFile' in environ:
-        execution_array.append('--ssl')
-        execution_array.extend(['--sslCAFile', environ['sslCAFile']])
+def restore_archive(archive, to_env, skip_indexes=False, workers=1, incremental=False):
+    """Restores a backup archive -- a ZipFile over a local file or S3 -- into to_env"""
+    restore_from_dump(native.ZipDump(archive), to_env, skip_indexes=skip_indexes, workers=workers,
+                      incremental=incremental)
 
-    for option in options:
-        execution_array.extend([option, options[option]])
+
+def restore_from_dump(dump, to_env, skip_indexes=False, workers=1, incremental=False):
+    """Restores a dump that is not a plain directory -- see native.ZipDump and chunks.ChunkedDump -- into to_env
+
+    The native engine loads straight from the dump.  mongorestore needs files, so the whole dump is extracted into a
+    temp directory first, decompressed, in one pass -- it needs the disk space of the uncompressed dump.  Incremental
+    backups are always upserted natively on top of what is already there.
+    """
+    if incremental:
+        upsert_natively(dump, to_env)
+        return
+
+    if restore_engine(to_env) == 'native':
+        if restore_mode(to_env) == 'swap':
+            restore_with_swap(to_env, lambda prefix: restore_natively(dump, to_env, skip_indexes, prefix))
+            return
+        drop(to_env)
+        restore_natively(dump, to_env, skip_indexes)
+        return
+
+    with temp_directory() as temp_dir:
+        dump.extract(temp_dir, workers=workers)
+        restore(temp_dir, to_env, skip_indexes=skip_indexes)
+
+
+def upsert_natively(dump, to_env):
+    connection = client_for(to_env)
+    database = connection[to_env['db_name']]
+
+    throttle = throttle_for(to_env, connection, label='restore')
+
+    started = time.time()
+    native.upsert_dump(dump, database,
+                       workers=to_env.get('restore_workers', native.DEFAULT_RESTORE_WORKERS),
+                       batch_size=to_env.get('restore_batch_size', native.DEFAULT_BATCH_SIZE),
+                       throttle=throttle)
+    echo("Applied incremental backup to {} in {:.1f}s".format(to_env['db_name'], time.time() - started))
+    if throttle is not None:
+        throttle.report()
+
+
+def restore_natively(dump, to_env, skip_indexes=False, collection_prefix=''):
+    connection = client_for(to_env)
+    database = connection[to_env['db_name']]
+
+    throttle = throttle_for(to_env, connection, label='restore')
+
+    started = time.time()
+    native.restore_dump(dump, database,
+                        workers=to_env.get('restore_workers', native.DEFAULT_RESTORE_WORKERS),
+                        batch_size=to_env.get('restore_batch_size', native.DEFAULT_BATCH_SIZE),
+                        skip_secondary_indexes=skip_indexes,
+                        throttle=throttle,
+                        collection_prefix=collection_prefix)
+    echo("Restored {} in {:.1f}s".format(to_env['db_name'], time.time() - started))
+    if throttle is not None:
+        throttle.report()
+
+
+def drop(environ):
+    """drops the database of environ, once confirmed"""
+    connection = client_for(environ)
 
     echo()
-    echo("You are about to execute the following database drop")
-    echo("    {}".format(' '.join(execution_array)))
+    echo("You are about to drop the database {} on {}".format(environ['db_name'], environ['host']))
     echo()
     click.confirm('ARE YOU SURE??', abort=True)
 
-    subprocess.call(' '.join(execution_array), shell=True)
+    connection.drop_database(environ['db_name'])
@@ -0,0 +1,263 @@
+"""
+Dump and restore over a pymongo connection, without the mongo tools.
+
+The files written here follow the mongodump layout -- one <collection>.bson file of concatenated documents plus a
+<collection>.metadata.json describing options and indexes -- so zipping, uploading and mongorestore all work on them
+unchanged.
+"""
+import os
+import re
+import shutil
+
+from bson import json_util, decode_file_iter, CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import IndexModel, ReplaceOne
+
+from .utils import WorkerPool, codec_of, strip_codec_suffix, decompressing_reader, COPY_BUFFER_SIZE
+
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_RESTORE_WORKERS = 4
+
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+SYSTEM_COLLECTION_RE = re.compile(r"system\.")
+
+
+def application_collection_names(database):
+    """returns the names of all non system collections in the database"""
+    return [name for name in database.collection_names() if not SYSTEM_COLLECTION_RE.match(name)]
+
+
+def bson_path(dump_dir, collection_name):
+    return os.path.join(dump_dir, '{}.bson'.format(collection_name))
+
+
+def metadata_path(dump_dir, collection_name):
+    return os.path.join(dump_dir, '{}.metadata.json'.format(collection_name))
+
+
+def dump_collection(database, collection_name, dump_dir, query=None, batch_size=DEFAULT_BATCH_SIZE, throttle=None,
+                    append=False):
+    """Writes <collection>.bson and <collection>.metadata.json into dump_dir, returns the number of bytes dumped
+
+    Documents are copied as raw BSON batches straight off the cursor, they are never decoded.  A throttle (see
+    throttle.py) is waited on before each batch.  With append the documents are added to an existing .bson file.
+    """
+    collection = database[collection_name]
+
+    bytes_written = 0
+    cursor = collection.find_raw_batches(query or {}, batch_size=batch_size)
+    try:
+        with open(bson_path(dump_dir, collection_name), 'ab' if append else 'wb') as f:
+            for batch in cursor:
+                if throttle is not None:
+                    throttle.wait()
+                f.write(batch)
+                bytes_written += len(batch)
+    finally:
+        cursor.close()
+
+    write_metadata(collection, dump_dir)
+    return bytes_written
+
+
+def write_metadata(collection, dump_dir):
+    indexes = []
+    for index in collection.list_indexes():
+        index = dict(index)
+        # mongorestore fills in the namespace of the database it restores into
+        index.pop('ns', None)
+        indexes.append(index)
+
+    metadata = {
+        'options': collection.options(),
+        'indexes': indexes,
+        'collectionName': collection.name,
+    }
+
+    with open(metadata_path(dump_dir, collection.name), 'w') as f:
+        f.write(json_util.dumps(metadata, json_options=json_util.CANONICAL_JSON_OPTIONS))
+
+
+def collection_names_of(file_names):
+    """the collections a list of mongodump file names describe"""
+    names = set()
+    for file_name in file_names:
+        if file_name.endswith('.metadata.json'):
+            names.add(file_name[:-len('.metadata.json')])
+        elif file_name.endswith('.bson'):
+            names.add(file_name[:-len('.bson')])
+    return sorted(name for name in names if not SYSTEM_COLLECTION_RE.match(name))
+
+
+class DirectoryDump(object):
+    """A dump laid out on disk the way mongodump leaves it: <dump_path>/<collection>.bson + .metadata.json"""
+
+    def __init__(self, dump_path):
+        self.dump_path = dump_path
+
+    def collection_names(self):
+        return collection_names_of(os.listdir(self.dump_path))
+
+    def open_bson(self, collection_name):
+        """returns a binary file object of the collection's documents, or None if there is no data file"""
+        path = bson_path(self.dump_path, collection_name)
+        if not os.path.exists(path):
+            return None
+        return open(path, 'rb')
+
+    def metadata(self, collection_name):
+        path = metadata_path(self.dump_path, collection_name)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json_util.loads(f.read())
+
+
+class ZipDump(object):
+    """A dump inside a backup archive, read member by member without extracting it -- unless extract is called
+
+    Members may be compressed on their own (see utils.zipdir), they are decompressed as they are read.
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        # uncompressed file name: archive member
+        self.members = {}
+        for member in archive.namelist():
+            self.members[strip_codec_suffix(os.path.basename(member))] = member
+
+    def collection_names(self):
+        return collection_names_of(self.members)
+
+    def _open(self, file_name):
+        member = self.members[file_name]
+        return decompressing_reader(self.archive.open(member), codec_of(member))
+
+    def open_bson(self, collection_name):
+        file_name = '{}.bson'.format(collection_name)
+        if file_name not in self.members:
+            return None
+        return self._open(file_name)
+
+    def metadata(self, collection_name):
+        file_name = '{}.metadata.json'.format(collection_name)
+        if file_name not in self.members:
+            return {}
+        with self._open(file_name) as f:
+            return json_util.loads(f.read().decode('utf-8'))
+
+    def extract(self, target_dir, workers=1):
+        """writes the dump into target_dir as plain mongodump files, `workers` members at a time"""
+        def extract_member(file_name):
+            with self._open(file_name) as source:
+                with open(os.path.join(target_dir, file_name), 'wb') as target:
+                    shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+
+        with WorkerPool(workers) as pool:
+            for file_name in self.members:
+                pool.submit(extract_member, file_name)
+            pool.join()
+
+
+def read_batches(bson_file, batch_size=DEFAULT_BATCH_SIZE):
+    """yields lists of undecoded documents from a .bson stream"""
+    batch = []
+    for document in decode_file_iter(bson_file, codec_options=RAW_CODEC_OPTIONS):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def index_models(metadata, skip_secondary_indexes=False):
+    """turns the index specs of a .metadata.json into IndexModels, leaving out the implicit _id index"""
+    models = []
+    for spec in metadata.get('indexes', []):
+        spec = dict(spec)
+        name = spec.pop('name')
+        if name == '_id_' or skip_secondary_indexes:
+            continue
+
+        key = list(spec.pop('key').items())
+        spec.pop('v', None)
+        spec.pop('ns', None)
+
+        if '_fts' in dict(key):
+            # text indexes are stored in their internal form, rebuild the key from the indexed fields
+            key = [(k, v) for k, v in key if k not in ('_fts', '_ftsx')]
+            key.extend((field, 'text') for field in spec.get('weights', {}))
+
+        models.append(IndexModel(key, name=name, **spec))
+    return models
+
+
+def restore_dump(dump, database, workers=DEFAULT_RESTORE_WORKERS, batch_size=DEFAULT_BATCH_SIZE,
+                 skip_secondary_indexes=False, throttle=None, collection_prefix=''):
+    """Loads every collection of the dump into database, then builds the indexes
+
+    Documents are read once, undecoded, and loaded with unordered insert_many batches spread over `workers`
+    threads.  Index builds wait until all data is in and then run in parallel across collections.  Collections are
+    restored as collection_prefix + their name.
+    """
+    collection_names = dump.collection_names()
+
+    with WorkerPool(workers) as pool:
+        for collection_name in collection_names:
+            options = dump.metadata(collection_name).get('options')
+            if options:
+                database.create_collection(collection_prefix + collection_name, **options)
+
+            bson_file = dump.open_bson(collection_name)
+            if bson_file is None:
+                continue
+
+            collection = database[collection_prefix + collection_name]
+            with bson_file:
+                for batch in read_batches(bson_file, batch_size):
+                    if throttle is not None:
+                        throttle.wait()
+                    pool.submit(collection.insert_many, batch, ordered=False)
+        pool.join()
+
+    with WorkerPool(workers) as pool:
+        for collection_name in collection_names:
+            models = index_models(dump.metadata(collection_name), skip_secondary_indexes)
+            if models:
+                pool.submit(database[collection_prefix + collection_name].create_indexes, models)
+        pool.join()
+
+
+def upsert_dump(dump, database, workers=DEFAULT_RESTORE_WORKERS, batch_size=DEFAULT_BATCH_SIZE, throttle=None):
+    """Applies the dump on top of what is in database, replacing documents by _id and inserting new ones
+
+    Used to replay incremental backups.  Indexes of collections that are new to the database are built afterwards.
+    """
+    collection_names = dump.collection_names()
+    existing = set(database.collection_names())
+
+    def upsert(collection, batch):
+        collection.bulk_write([ReplaceOne({'_id': document['_id']}, document, upsert=True) for document in batch],
+                              ordered=False)
+
+    with WorkerPool(workers) as pool:
+        for collection_name in collection_names:
+            bson_file = dump.open_bson(collection_name)
+            if bson_file is None:
+                continue
+
+            collection = database[collection_name]
+            with bson_file:
+                for batch in read_batches(bson_file, batch_size):
+                    if throttle is not None:
+                        throttle.wait()
+                    pool.submit(upsert, collection, batch)
+        pool.join()
+
+    for collection_name in collection_names:
+        if collection_name not in existing:
+            models = index_models(dump.metadata(collection_name))
+            if models:
+                database[collection_name].create_indexes(models)
@@ -0,0 +1,219 @@
+"""
+Query profiling for migrations
+
+With --profile-queries, migrate and migrate_one register a QueryProfiler, a pymongo command listener, before they
+connect.  It groups the reads and writes each migration sends by query shape -- the filter with its values left out --
+and adds up how often each ran and how long it took, getMore round trips included.  After the migration every shape
+is explained once, with one of the filters actually sent, to tell collection scans from index scans:
+
+    Queries of AddIndexesMigration:
+      COUNT     TOTAL   PLAN      COMMAND  COLLECTION  SHAPE
+         12  8412.3ms   COLLSCAN  find     users       {"email": "?"}
+
+Migrations are profiled one at a time, so every query is put down to the migration that sent it.
+"""
+import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from click import echo
+from pymongo import monitoring
+
+# command name: where its filter is
+FILTER_FIELDS = {
+    'find': 'filter',
+    'count': 'query',
+    'distinct': 'query',
+    'findAndModify': 'query',
+    'findandmodify': 'query',
+    'update': 'updates',
+    'delete': 'deletes',
+    'aggregate': 'pipeline',
+}
+# plan stages, most telling first
+PLAN_STAGES = ('COLLSCAN', 'IXSCAN', 'IDHACK', 'COUNT_SCAN', 'DISTINCT_SCAN', 'EOF')
+
+
+def query_shape(value):
+    """the filter with every value replaced by '?', keeping field names and operators"""
+    if isinstance(value, dict):
+        return OrderedDict((key, query_shape(value[key])) for key in value)
+    if isinstance(value, (list, tuple)):
+        # $and / $or / $in: the shape of the distinct members
+        shapes = []
+        for member in value:
+            shape = query_shape(member)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return '?'
+
+
+def command_filter(command_name, command):
+    """the filter a command reads or writes by, {} if it has none"""
+    field = FILTER_FIELDS[command_name]
+    if field in ('updates', 'deletes'):
+        statements = command.get(field) or [{}]
+        return statements[0].get('q', {})
+    if field == 'pipeline':
+        stages = command.get(field) or [{}]
+        return stages[0].get('$match', {})
+    return command.get(field) or {}
+
+
+def plan_type(explained):
+    """the most telling stage of an explain's winning plan -- COLLSCAN, IXSCAN, ... -- or None"""
+    stages = set()
+
+    def walk(plan):
+        if isinstance(plan, dict):
+            if 'stage' in plan:
+                stages.add(plan['stage'])
+            for value in plan.values():
+                walk(value)
+        elif isinstance(plan, list):
+            for value in plan:
+                walk(value)
+
+    walk(explained.get('queryPlanner', {}).get('winningPlan', {}))
+    for stage in PLAN_STAGES:
+        if stage in stages:
+            return stage
+    return sorted(stages)[0] if stages else None
+
+
+class QueryShape(object):
+    """the queries of one shape a migration sent to one collection"""
+
+    def __init__(self, database, collection, command_name, shape, sample_filter):
+        self.database = database
+        self.collection = collection
+        self.command_name = command_name
+        self.shape = shape
+        self.sample_filter = sample_filter
+        self.count = 0
+        self.total_ms = 0.0
+        self.plan = None
+
+
+class QueryProfiler(monitoring.CommandListener):
+    """Collects the query shapes of the migration being profiled, see profile()"""
+
+    def __init__(self, ignored_collections=()):
+        # monarch's own bookkeeping, e.g. the migration history
+        self.ignored_collections = set(ignored_collections)
+        self.label = None
+        # label: {(database, collection, command, shape json): QueryShape}
+        self.shapes = OrderedDict()
+        # request id: (label, key) of the query, for commands still running
+        self._started = {}
+        # cursor id: (label, key) of the query that opened it
+        self._cursors = {}
+        self._lock = threading.Lock()
+
+    def profile(self, label):
+        """start putting queries down to label, None to stop"""
+        with self._lock:
+            self.label = label
+            if label is not None:
+                self.shapes.setdefault(label, OrderedDict())
+                # cursors left open by the previous migration are none of this one's business
+                self._cursors = {}
+
+    def started(self, event):
+        command_name = event.command_name
+        with self._lock:
+            if self.label is None:
+                return
+            if command_name == 'getMore':
+                query = self._cursors.get(event.command.get('getMore'))
+                if query is not None:
+                    self._started[event.request_id] = query
+                return
+            if command_name not in FILTER_FIELDS:
+                return
+
+            collection = event.command.get(command_name)
+            if collection in self.ignored_collections:
+                return
+            sample_filter = command_filter(command_name, event.command)
+            shape = json.dumps(query_shape(sample_filter), default=str)
+            key = (event.database_name, collection, command_name, shape)
+            shapes = self.shapes[self.label]
+            if key not in shapes:
+                shapes[key] = QueryShape(event.database_name, collection, command_name, shape, sample_filter)
+            shapes[key].count += 1
+            self._started[event.request_id] = (self.label, key)
+
+    def succeeded(self, event):
+        with self._lock:
+            query = self._started.pop(event.request_id, None)
+            if query is None:
+                return
+            label, key = query
+            self.shapes[label][key].total_ms += event.duration_micros / 1000.0
+            cursor = event.reply.get('cursor') or {}
+            if cursor.get('id'):
+                self._cursors[cursor['id']] = query
+
+    def failed(self, event):
+        with self._lock:
+            query = self._started.pop(event.request_id, None)
+            if query is not None:
+                label, key = query
+                self.shapes[label][key].total_ms += event.duration_micros / 1000.0
+
+    def explain(self, client, label):
+        """finds the plan of every shape label sent, with profiling paused so the explains are not counted"""
+        previous = self.label
+        self.profile(None)
+        try:
+            for query in self.shapes.get(label, {}).values():
+                if query.collection is None:
+                    continue
+                try:
+                    explained = client[query.database].command(
+                        'explain', {'find': query.collection, 'filter': query.sample_filter},
+                        verbosity='queryPlanner')
+                except Exception as e:
+                    echo("Could not explain {} on {}: [{}]".format(query.shape, query.collection, e))
+                else:
+                    query.plan = plan_type(explained)
+        finally:
+            self.profile(previous)
+
+    @contextmanager
+    def profiling(self, client, label):
+        """puts the queries sent inside the block down to label, then explains and reports them"""
+        self.profile(label)
+        try:
+            yield
+        finally:
+            self.profile(None)
+            self.explain(client, label)
+            self.report(label)
+
+    def report(self, label):
+        queries = sorted(self.shapes.get(label, {}).values(), key=lambda query: query.total_ms, reverse=True)
+        if not queries:
+            echo("No queries by {}".format(label))
+            return
+        echo("Queries of {}:".format(label))
+        row = "  {:>7} {:>11}   {:9} {:14} {:20} {}"
+        echo(row.format('COUNT', 'TOTAL', 'PLAN', 'COMMAND', 'COLLECTION', 'SHAPE'))
+        for query in queries:
+            echo(row.format(query.count, '{:.1f}ms'.format(query.total_ms), query.plan or '-',
+                            query.command_name, query.collection, query.shape))
+
+        scans = sorted(set(query.collection for query in queries if query.plan == 'COLLSCAN'))
+        if scans:
+            echo("  collection scans on: {} -- consider an index before running this against production".format(
+                ", ".join(scans)))
+
+
+def register_profiler(ignored_collections=()):
+    """a QueryProfiler listening to every client created from now on"""
+    profiler = QueryProfiler(ignored_collections)
+    monitoring.register(profiler)
+    return profiler
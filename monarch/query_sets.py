@@ -1,9 +1,6 @@
 import os
-import re
-import sys
-import inspect
-from glob import glob
-from importlib import import_module
+
+from .discovery import discover
 
 
 def generate_queryset_name(folder, name):
@@ -16,15 +13,9 @@ def generate_queryset_name(folder, name):
 
 
 def querysets(config):
+    """returns {query set class name: query set class}, the modules are imported once a class is used"""
     query_sets = {}
-
-    for file in glob('{}/*_queryset.py'.format(config.queryset_directory)):
-        queryset_name = os.path.splitext(os.path.basename(file))[0]
-        if sys.version_info >= (3, 3):
-            from importlib import invalidate_caches
-            invalidate_caches()
-        queryset_module = import_module("querysets.{}".format(queryset_name))
-        for name, obj in inspect.getmembers(queryset_module):
-            if inspect.isclass(obj) and re.search('QuerySet$', name) and name not in ['QuerySet']:
-                query_sets[name] = obj
-    return query_sets
\ No newline at end of file
+    for module_name, query_set_class in discover(config.queryset_directory, '*_queryset.py', 'querysets',
+                                                 'QuerySet$', excluded=('QuerySet',)):
+        query_sets[query_set_class.class_name] = query_set_class
+    return query_sets
@@ -1,81 +1,438 @@
-import os
+import json
+import uuid
+import hashlib
+import threading
+import zipfile
+from io import BytesIO
 from datetime import datetime
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 # 3rd Party Imports
 import boto
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
+from boto.exception import S3ResponseError
 from click import echo
 
-from .utils import temp_directory, zipdir
-from .local import local_restore
-from .mongo import dump_db
+from .utils import zipdir, compression_options, WorkerPool
+from .mongo import dump_db, restore_archive, restore_from_dump
+from .chunks import ChunkedDump, CHUNK_DIR, DEFAULT_CHUNK_SIZE, storage_mode, store_dump, chunk_digest, \
+    describe_manifest, manifest_to_json, manifest_from_json
+from .catalog import Catalog, CATALOG_NAME, BACKUP_SUFFIX, MANIFEST_SUFFIX, HashingWriter, catalog_entry, \
+    describe_dump, backup_name_base, is_backup_name, reservation_entry
 
+MB = 1024 * 1024
 
-def get_s3_bucket(s3_settings):
+# S3 refuses parts smaller than this, except for the last one
+MIN_PART_SIZE = 5 * MB
+DEFAULT_PART_SIZE = 64 * MB
+DEFAULT_UPLOAD_CONCURRENCY = 4
+
+DEFAULT_BLOCK_SIZE = 16 * MB
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+
+# what a conditional PUT fails with when the key exists, or another conditional PUT of it is in flight
+CONDITION_FAILED = (409, 412)
+
+
+def get_s3_bucket(s3_settings, validate=True):
     conn = boto.connect_s3(s3_settings['aws_access_key_id'], s3_settings['aws_secret_access_key'])
-    bucket = conn.get_bucket(s3_settings['bucket_name'])
+    bucket = conn.get_bucket(s3_settings['bucket_name'], validate=validate)
     return bucket
 
 
-def generate_uniqueish_key(s3_settings, environment, name_prefix):
-    bucket = get_s3_bucket(s3_settings)
+class ThreadLocalBucket(threading.local):
+    """boto connections are not thread safe, this hands each thread a bucket on its own connection"""
+
+    def __init__(self, s3_settings):
+        self.s3_settings = s3_settings
+        self.bucket = None
+
+    def get(self):
+        if self.bucket is None:
+            self.bucket = get_s3_bucket(self.s3_settings, validate=False)
+        return self.bucket
+
+
+def s3_catalog(s3_settings, bucket=None):
+    """reads the catalog from the bucket in one GET, building it first if the bucket has never had one"""
+    bucket = bucket or get_s3_bucket(s3_settings)
+    key = bucket.get_key(CATALOG_NAME)
+    if key is None:
+        return rebuild_s3_catalog(s3_settings, bucket=bucket)
+    return Catalog.from_json(key.get_contents_as_string().decode('utf-8'))
+
 
-    if name_prefix and name_prefix != '':
-        name_base = name_prefix
-    else:
-        name_base = environment['db_name']
+def save_s3_catalog(s3_settings, catalog, bucket=None):
+    bucket = bucket or get_s3_bucket(s3_settings, validate=False)
+    Key(bucket, CATALOG_NAME).set_contents_from_string(catalog.to_json())
 
-    name_attempt = "{}__{}.dmp.zip".format(name_base, datetime.utcnow().strftime("%Y_%m_%d"))
 
-    key = bucket.get_key(name_attempt)
+def rebuild_s3_catalog(s3_settings, bucket=None):
+    """lists the whole bucket (all pages of it) and records every backup, keeping what the catalog already knew"""
+    bucket = bucket or get_s3_bucket(s3_settings)
 
-    if not key:
-        key = Key(bucket)
-        key.key = name_attempt
-        return key
-    else:
-        counter = 1
-        while True:
-            counter += 1
-            name_attempt = "{}__{}_{}.dmp.zip".format(name_base,
-                                          datetime.utcnow().strftime("%Y_%m_%d"), counter)
+    known = Catalog()
+    key = bucket.get_key(CATALOG_NAME)
+    if key is not None:
+        known = Catalog.from_json(key.get_contents_as_string().decode('utf-8'))
 
-            if bucket.get_key(name_attempt):
+    found = {}
+    for key in bucket.list():
+        if not key.size:
+            # the placeholder of a backup still being written, see reserve_uniqueish_key
+            continue
+        if key.name.endswith(MANIFEST_SUFFIX):
+            codec, collections = describe_manifest(manifest_from_json(key.get_contents_as_string().decode('utf-8')))
+            found[key.name] = catalog_entry(key.name, key.size, codec=codec, storage='chunked',
+                                            collections=dict((name, None) for name in collections))
+        elif is_backup_name(key.name):
+            found[key.name] = catalog_entry(key.name, key.size)
+
+    catalog = known.rebuilt(found)
+    save_s3_catalog(s3_settings, catalog, bucket=bucket)
+    return catalog
+
+
+def generate_uniqueish_key(s3_settings, environment, name_prefix, catalog=None, suffix=BACKUP_SUFFIX):
+    if catalog is None:
+        catalog = s3_catalog(s3_settings)
+
+    name_attempt = catalog.unique_name(backup_name_base(environment, name_prefix), suffix)
+    return Key(get_s3_bucket(s3_settings, validate=False), name_attempt)
+
+
+def reserve_uniqueish_key(s3_settings, environment, name_prefix, suffix=BACKUP_SUFFIX):
+    """Like generate_uniqueish_key, and holds the name until the backup is done
+
+    The name is held by an empty placeholder object put at the key only if there is nothing there yet
+    (If-None-Match: *), the next name is tried if another backup got there first.  Stores that ignore the condition
+    -- S3 before August 2024, some S3 compatible ones -- make this best effort: two backups starting together may
+    still pick the same name.  The catalog gets a placeholder entry too so listings skip the backup until it is done.
+    Returns the Key and the token of the catalog placeholder, see release_s3_key for a backup that fails.
+    """
+    bucket = get_s3_bucket(s3_settings)
+    token = uuid.uuid4().hex
+    taken = set()
+    while True:
+        catalog = s3_catalog(s3_settings, bucket=bucket)
+        name = catalog.unique_name(backup_name_base(environment, name_prefix), suffix, taken=taken)
+        taken.add(name)
+        if bucket.get_key(name) is not None:
+            # written by a backup the catalog lost track of, never overwrite it
+            continue
+        key = Key(bucket, name)
+        try:
+            key.set_contents_from_string(b'', headers={'If-None-Match': '*'})
+        except S3ResponseError as e:
+            if e.status in CONDITION_FAILED:
                 continue
-            else:
-                key = Key(bucket)
-                key.key = name_attempt
-                return key
+            raise
+        update_s3_catalog(s3_settings, name, reservation_entry(name, token))
+        return key, token
+
+
+def release_s3_key(s3_settings, key):
+    """gives back the name of a backup that failed, its placeholder object and catalog entry go"""
+    key.delete()
+    update_s3_catalog(s3_settings, key.key)
+
+
+def update_s3_catalog(s3_settings, name, entry=None, attempts=5):
+    """Puts entry into the catalog under name, or takes name out without one, and reads it back
+
+    Another backup saving the catalog at the same moment may write over the change, which is then made again.
+    """
+    bucket = get_s3_bucket(s3_settings)
+    # as it reads back
+    expected = json.loads(json.dumps(entry))
+    for _ in range(attempts):
+        catalog = s3_catalog(s3_settings, bucket=bucket)
+        if entry is None:
+            catalog.remove(name)
+        else:
+            catalog.add(entry)
+        save_s3_catalog(s3_settings, catalog, bucket=bucket)
+        saved = s3_catalog(s3_settings, bucket=bucket).entries.get(name)
+        if saved is not None:
+            # the catalog numbered it
+            saved = dict((field, value) for field, value in saved.items() if field != 'sequence')
+        if saved == expected:
+            return
+    echo("The catalog keeps changing under {}, run rebuild_catalog once the backups are done".format(name))
+
+
+class MultipartUploadWriter(object):
+    """A write only file object that sends what is written to it to S3 as a multipart upload
+
+    Every `part_size` bytes become a part, and up to `concurrency` parts are uploaded at once.  Writes block while
+    that many parts are in flight, so memory stays around part_size * (concurrency + 1).
+    """
+
+    def __init__(self, s3_settings, key_name, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_UPLOAD_CONCURRENCY):
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.multipart = get_s3_bucket(s3_settings).initiate_multipart_upload(key_name)
+        self.bytes_written = 0
+        self._buckets = ThreadLocalBucket(s3_settings)
+        self._buffer = BytesIO()
+        self._part_number = 0
+        self._pool = WorkerPool(concurrency)
+
+    def write(self, data):
+        self._buffer.write(data)
+        self.bytes_written += len(data)
+        if self._buffer.tell() >= self.part_size:
+            self._send_part()
+        return len(data)
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    def _send_part(self):
+        self._part_number += 1
+        part, self._buffer = self._buffer, BytesIO()
+        part.seek(0)
+        self._pool.submit(self._upload_part, part, self._part_number)
+
+    def _upload_part(self, part, part_number):
+        multipart = MultiPartUpload(self._buckets.get())
+        multipart.key_name = self.multipart.key_name
+        multipart.id = self.multipart.id
+        multipart.upload_part_from_file(part, part_number)
+
+    def close(self):
+        """uploads what is left and completes the upload, cancelling it if any part failed"""
+        if self._buffer.tell() or self._part_number == 0:
+            self._send_part()
+        try:
+            self._pool.join()
+        except Exception:
+            self.abort()
+            raise
+        self.multipart.complete_upload()
+
+    def abort(self):
+        """cancels the upload once the parts still in flight are done, a part landing after the cancel would linger"""
+        try:
+            self._pool.join()
+        except Exception:
+            # the failed part is what the upload is being cancelled for
+            pass
+        self.multipart.cancel_upload()
 
 
-def backup_to_s3(environment, s3_settings, name, query_set_class):
+class S3ChunkStore(object):
+    """The chunks of chunked backups, one key each under chunks/ in the bucket"""
+
+    def __init__(self, s3_settings):
+        self.s3_settings = s3_settings
+        self._buckets = ThreadLocalBucket(s3_settings)
+
+    def known_chunks(self):
+        # one listing up front instead of a HEAD per chunk
+        prefix = CHUNK_DIR + '/'
+        return dict((chunk_digest(key.name[len(prefix):]), key.name[len(prefix):])
+                    for key in self._buckets.get().list(prefix=prefix))
+
+    def put_chunk(self, chunk_name, data):
+        Key(self._buckets.get(), '{}/{}'.format(CHUNK_DIR, chunk_name)).set_contents_from_string(data)
+
+    def get_chunk(self, chunk_name):
+        return Key(self._buckets.get(), '{}/{}'.format(CHUNK_DIR, chunk_name)).get_contents_as_string()
+
+
+def backup_to_s3(environment, s3_settings, name, query_set_class, environment_name=None, catalog_fields=None):
 
     dump_path = dump_db(environment, QuerySet=query_set_class)
-    zipf = zipdir(dump_path)
+    compression = compression_options(s3_settings)
+
+    if storage_mode(s3_settings) == 'chunked':
+        return backup_chunks_to_s3(environment, s3_settings, name, dump_path, compression,
+                                   environment_name=environment_name, catalog_fields=catalog_fields)
+
+    key, _ = reserve_uniqueish_key(s3_settings, environment, name)
 
-    key = generate_uniqueish_key(s3_settings, environment, name)
+    try:
+        upload = MultipartUploadWriter(s3_settings, key.key,
+                                       part_size=s3_settings.get('multipart_part_size', DEFAULT_PART_SIZE),
+                                       concurrency=s3_settings.get('multipart_concurrency',
+                                                                   DEFAULT_UPLOAD_CONCURRENCY))
+        archive = HashingWriter(upload)
+        try:
+            zipdir(dump_path, target=archive, **compression)
+        except Exception:
+            upload.abort()
+            raise
+        upload.close()
+    except Exception:
+        # give the name back
+        release_s3_key(s3_settings, key)
+        raise
 
-    bytes_written = key.set_contents_from_filename(zipf.filename)
+    update_s3_catalog(s3_settings, key.key, catalog_entry(key.key, archive.bytes_written,
+                                                          environment_name=environment_name,
+                                                          db_name=environment['db_name'],
+                                                          codec=compression['codec'],
+                                                          collections=describe_dump(dump_path),
+                                                          checksum=archive.checksum,
+                                                          **(catalog_fields or {})))
 
     # 4) print out the name of the bucket
-    echo("Wrote {} bytes to s3".format(bytes_written))
+    echo("Wrote {} bytes to s3 as {}".format(upload.bytes_written, key.key))
+
+
+def backup_chunks_to_s3(environment, s3_settings, name, dump_path, compression, environment_name=None,
+                        catalog_fields=None):
+    """uploads the chunks of the dump the bucket does not have yet, then the manifest listing all of them"""
+    key, _ = reserve_uniqueish_key(s3_settings, environment, name, suffix=MANIFEST_SUFFIX)
 
+    try:
+        manifest, stats = store_dump(dump_path, S3ChunkStore(s3_settings),
+                                     codec=compression['codec'], level=compression['level'],
+                                     chunk_size=s3_settings.get('chunk_size', DEFAULT_CHUNK_SIZE),
+                                     workers=s3_settings.get('multipart_concurrency', DEFAULT_UPLOAD_CONCURRENCY))
+        manifest_json = manifest_to_json(manifest).encode('utf-8')
+        key.set_contents_from_string(manifest_json)
+    except Exception:
+        release_s3_key(s3_settings, key)
+        raise
 
-def s3_restore(key, to_enviornment):
+    update_s3_catalog(s3_settings, key.key, catalog_entry(
+        key.key, len(manifest_json),
+        environment_name=environment_name,
+        db_name=environment['db_name'],
+        codec=compression['codec'],
+        collections=describe_dump(dump_path),
+        checksum='sha256:{}'.format(hashlib.sha256(manifest_json).hexdigest()),
+        storage='chunked',
+        **dict(stats, **(catalog_fields or {}))))
 
-    with temp_directory() as temp_dir:
-        zip_path = os.path.join(temp_dir, 'MongoDump.zip')
-        key.get_contents_to_filename(zip_path)
-        local_restore(zip_path, to_enviornment)
+    echo("Uploaded {new_chunks} new of {chunks} chunks ({new_chunk_bytes} bytes) to s3 for {name}".format(
+        name=key.key, **stats))
 
 
-def s3_backups(s3_config):
-    """ a dict of key.name: key
+class S3RangeReader(object):
+    """A read only, seekable file object over an S3 key, fetched with concurrent ranged GETs
+
+    Reads are served from `block_size` blocks.  Every read also starts fetching the next `concurrency` blocks, so a
+    sequential reader rarely waits on S3 and the object is never downloaded as a whole.
     """
-    bucket = get_s3_bucket(s3_config)
+
+    def __init__(self, s3_settings, key_name, size=None, block_size=DEFAULT_BLOCK_SIZE,
+                 concurrency=DEFAULT_DOWNLOAD_CONCURRENCY):
+        self.key_name = key_name
+        self.block_size = block_size
+        self.concurrency = max(1, concurrency)
+        self._buckets = ThreadLocalBucket(s3_settings)
+
+        if size is None:
+            size = self._buckets.get().get_key(key_name).size
+        self.size = size
+        self.block_count = (size + block_size - 1) // block_size
+
+        self.position = 0
+        self._pool = ThreadPool(self.concurrency)
+        self._lock = threading.Lock()
+        # block index: AsyncResult, least recently used first
+        self._blocks = OrderedDict()
+        self._max_cached_blocks = 4 * (self.concurrency + 1)
+
+    def _fetch(self, index):
+        start = index * self.block_size
+        end = min(start + self.block_size, self.size) - 1
+        key = Key(self._buckets.get(), self.key_name)
+        return key.get_contents_as_string(headers={'Range': 'bytes={}-{}'.format(start, end)})
+
+    def _block(self, index):
+        with self._lock:
+            for ahead in range(index, min(index + self.concurrency + 1, self.block_count)):
+                if ahead not in self._blocks:
+                    self._blocks[ahead] = self._pool.apply_async(self._fetch, (ahead,))
+
+            result = self._blocks.pop(index)
+            self._blocks[index] = result
+
+            while len(self._blocks) > self._max_cached_blocks:
+                self._blocks.popitem(last=False)
+
+        return result.get()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+
+        chunks = []
+        while size > 0:
+            index, offset = divmod(self.position, self.block_size)
+            chunk = self._block(index)[offset:offset + size]
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+
+        return b''.join(chunks)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.position = offset
+        elif whence == 1:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def s3_restore(key, to_enviornment, s3_settings, skip_indexes=False, workers=1, incremental=False):
+    """Restores straight out of S3, the archive is read with ranged GETs and never lands on disk as a whole
+
+    mongorestore still gets its members extracted into a temp directory, see restore_from_dump.
+    """
+    if key.name.endswith(MANIFEST_SUFFIX):
+        manifest = manifest_from_json(key.get_contents_as_string().decode('utf-8'))
+        dump = ChunkedDump(manifest, S3ChunkStore(s3_settings),
+                           prefetch=s3_settings.get('download_concurrency', DEFAULT_DOWNLOAD_CONCURRENCY))
+        restore_from_dump(dump, to_enviornment, skip_indexes=skip_indexes, workers=workers, incremental=incremental)
+        return
+
+    with S3RangeReader(s3_settings, key.name, size=key.size,
+                       block_size=s3_settings.get('download_block_size', DEFAULT_BLOCK_SIZE),
+                       concurrency=s3_settings.get('download_concurrency', DEFAULT_DOWNLOAD_CONCURRENCY)) as reader:
+        with zipfile.ZipFile(reader) as archive:
+            restore_archive(archive, to_enviornment, skip_indexes=skip_indexes, workers=workers,
+                            incremental=incremental)
+
+
+def s3_backups(s3_config, catalog=None):
+    """ a dict of key.name: key, read from the catalog
+    """
+    bucket = get_s3_bucket(s3_config, validate=False)
 
     buckets = {}
-    for key in bucket.get_all_keys():
+    if catalog is None:
+        catalog = s3_catalog(s3_config, bucket=bucket)
+
+    for entry in catalog:
+        key = Key(bucket, entry['name'])
+        key.size = entry['size']
         buckets[key.name] = key
 
     return buckets
@@ -0,0 +1,107 @@
+"""
+Samples of a database, for `copy_db --sample` and `backup --sample`
+
+--sample takes a percentage ('1%') or a number of documents ('5000') per collection.  Documents are picked either at
+random with $sample, or as one contiguous _id range starting at a random document, which only walks the _id index
+and is kinder to big collections:
+
+    monarch copy_db production:development --sample 1%
+    monarch copy_db production:development --sample 5000 --sample-method range --keep-references
+
+With --keep-references the documents the sampled ones refer to, following the 'relationships' declared on the
+source environment (see subsets.py), are copied too:
+
+    'relationships': ['dog_houses.dog_id -> dogs._id'],
+"""
+from collections import OrderedDict
+
+from click import echo
+
+from .models import QuerySet
+from .subsets import IdSet, add_referenced_ids
+
+SAMPLE_METHODS = ('random', 'range')
+
+
+def parse_sample(text):
+    """('percent', 1.5) for '1.5%', ('count', 5000) for '5000', raises ValueError for anything else"""
+    text = str(text).strip()
+    try:
+        if text.endswith('%'):
+            percent = float(text[:-1])
+            if 0 < percent <= 100:
+                return 'percent', percent
+        else:
+            count = int(text)
+            if count > 0:
+                return 'count', count
+    except ValueError:
+        pass
+    raise ValueError("--sample takes a percentage like 1% or a number of documents like 5000, got [{}]".format(text))
+
+
+def sample_size(sample, document_count):
+    """how many documents of a collection of document_count the sample takes"""
+    kind, amount = sample
+    if kind == 'count':
+        return min(amount, document_count)
+    if not document_count:
+        return 0
+    return max(1, int(round(document_count * amount / 100.0)))
+
+
+def sample_ids(collection, size, method='random'):
+    """an IdSet of `size` _ids of the collection, picked by method"""
+    if size <= 0:
+        return IdSet()
+
+    if method == 'random':
+        return IdSet(document['_id'] for document in
+                     collection.aggregate([{'$sample': {'size': size}}, {'$project': {'_id': 1}}]))
+
+    start = [document['_id'] for document in collection.aggregate([{'$sample': {'size': 1}}, {'$project': {'_id': 1}}])]
+    if not start:
+        return IdSet()
+    cursor = collection.find({'_id': {'$gte': start[0]}}, {'_id': 1}).sort('_id', 1).limit(size)
+    return IdSet(document['_id'] for document in cursor)
+
+
+class SampleQuerySet(QuerySet):
+    """Dumps a sample of every collection, and what the sampled documents refer to if asked"""
+
+    sample = ('percent', 1.0)
+    method = 'random'
+    keep_references = False
+
+    def run(self):
+        selected = OrderedDict()
+        for collection_name in self.application_collection_names:
+            collection = self.database[collection_name]
+            selected[collection_name] = sample_ids(
+                collection, sample_size(self.sample, collection.estimated_document_count()), self.method)
+
+        if self.keep_references:
+            sampled = dict((name, len(ids)) for name, ids in selected.items())
+            add_referenced_ids(self.database, self.relationships, selected, self.in_batch_size)
+            for name, ids in selected.items():
+                if len(ids) > sampled.get(name, 0):
+                    echo("{:40} {} more documents to keep references".format(name, len(ids) - sampled.get(name, 0)))
+
+        for collection_name, ids in selected.items():
+            echo("{:40} {} sampled documents".format(collection_name, len(ids)))
+            self.dump_ids(collection_name, ids)
+
+    def only(self):
+        return self.touched_collections
+
+
+def sample_query_set(environment, sample, method='random', keep_references=False):
+    """a SampleQuerySet class taking sample, see parse_sample, of every collection of environment"""
+    if method not in SAMPLE_METHODS:
+        raise ValueError("the sample method must be one of {}, got {}".format(", ".join(SAMPLE_METHODS), method))
+    return type('SampleQuerySet', (SampleQuerySet,), {
+        'sample': sample,
+        'method': method,
+        'keep_references': keep_references,
+        'relationships': environment.get('relationships', []),
+    })
@@ -0,0 +1,205 @@
+"""
+Relationship aware subsets
+
+A QuerySet can declare the foreign keys between its collections,
+
+    relationships = ['dog_houses.dog_id -> dogs._id', 'dogs.owner_id -> people._id']
+
+and call self.dump_related('dogs', {'type': 'Awesome'}) to dump the awesome dogs together with everything they
+bring along: going down, the documents that refer to them (their dog houses) and the ones referring to those, and
+so on; then going up, the documents every one of those refers to (their owners), so no reference in the subset
+dangles.  Going up never turns back down -- an owner does not bring along the rest of their dogs.
+
+_ids are streamed off cursors into IdSets and looked up `in_batch_size` at a time with $in, so neither memory nor
+query size grows with one big list.
+"""
+import re
+from collections import namedtuple, OrderedDict
+
+from bson import BSON, ObjectId
+from click import echo
+
+DEFAULT_IN_BATCH_SIZE = 10000
+
+RELATIONSHIP_RE = re.compile(r"^\s*([^.\s]+)\.(\S+)\s*->\s*([^.\s]+)\.(\S+)\s*$")
+
+# collection.field refers to target.target_field
+Relationship = namedtuple('Relationship', ['collection', 'field', 'target', 'target_field'])
+
+
+def parse_relationship(relationship):
+    """a Relationship out of 'dog_houses.dog_id -> dogs._id'"""
+    if isinstance(relationship, Relationship):
+        return relationship
+    match = RELATIONSHIP_RE.match(relationship)
+    if not match:
+        raise Exception("relationships look like 'dog_houses.dog_id -> dogs._id', got [{}]".format(relationship))
+    return Relationship(*match.groups())
+
+
+class IdSet(object):
+    """A set of _ids kept compact -- ObjectIds as their 12 bytes, embedded documents as their BSON"""
+
+    def __init__(self, ids=()):
+        self._ids = set()
+        for value in ids:
+            self.add(value)
+
+    @staticmethod
+    def _pack(value):
+        if isinstance(value, ObjectId):
+            return value.binary
+        if isinstance(value, dict):
+            return ('document', BSON.encode(value))
+        if isinstance(value, bytes):
+            return ('bytes', value)
+        return value
+
+    @staticmethod
+    def _unpack(value):
+        if isinstance(value, bytes):
+            return ObjectId(value)
+        if isinstance(value, tuple):
+            kind, packed = value
+            return BSON(packed).decode() if kind == 'document' else packed
+        return value
+
+    def add(self, value):
+        """adds value, returns whether it is new"""
+        packed = self._pack(value)
+        if packed in self._ids:
+            return False
+        self._ids.add(packed)
+        return True
+
+    def update(self, values):
+        """adds values, returns an IdSet of the ones that are new"""
+        added = IdSet()
+        for value in values:
+            if self.add(value):
+                added.add(value)
+        return added
+
+    def __contains__(self, value):
+        return self._pack(value) in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return (self._unpack(value) for value in self._ids)
+
+    def chunks(self, size):
+        """the values, `size` at a time"""
+        chunk = []
+        for value in self:
+            chunk.append(value)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def in_queries(field, values, size=DEFAULT_IN_BATCH_SIZE):
+    """{field: {'$in': chunk}} for every `size` values, at least one query even if there are no values"""
+    empty = True
+    for chunk in values.chunks(size) if isinstance(values, IdSet) else IdSet(values).chunks(size):
+        empty = False
+        yield {field: {'$in': chunk}}
+    if empty:
+        yield {field: {'$in': []}}
+
+
+def field_values(document, field):
+    """the values at a dotted field of a document, arrays flattened"""
+    values = [document]
+    for part in field.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict) and part in value:
+                value = value[part]
+                found.extend(value if isinstance(value, list) else [value])
+        values = found
+    return values
+
+
+def _values_of(database, collection_name, ids, field, size):
+    """the values of field across the documents of collection_name with the given _ids"""
+    if field == '_id':
+        return ids
+    values = IdSet()
+    for query in in_queries('_id', ids, size):
+        for document in database[collection_name].find(query, {field: 1}):
+            values.update(field_values(document, field))
+    return values
+
+
+def _ids_where(database, collection_name, field, values, size):
+    """the _ids of the documents of collection_name whose field is one of values"""
+    if field == '_id':
+        return values
+    ids = IdSet()
+    for query in in_queries(field, values, size):
+        for document in database[collection_name].find(query, {'_id': 1}):
+            ids.add(document['_id'])
+    return ids
+
+
+def related_ids(database, relationships, collection_name, query=None, size=DEFAULT_IN_BATCH_SIZE):
+    """Returns {collection name: IdSet} of the documents matching query and the ones related to them
+
+    Follows relationships down to the documents referring to the selected ones, then up to the documents the
+    selected ones refer to (add_referenced_ids), see the module docstring.
+    """
+    relationships = [parse_relationship(relationship) for relationship in relationships]
+    selected = OrderedDict()
+
+    def select(name, ids):
+        """adds ids to the selection of collection name, returns the ones that were not in it"""
+        return selected.setdefault(name, IdSet()).update(ids)
+
+    root_ids = (document['_id'] for document in database[collection_name].find(query or {}, {'_id': 1}))
+    pending = [(collection_name, select(collection_name, root_ids))]
+
+    # down: whatever refers to a selected document
+    while pending:
+        name, ids = pending.pop(0)
+        for relationship in relationships:
+            if relationship.target != name or not len(ids):
+                continue
+            values = _values_of(database, name, ids, relationship.target_field, size)
+            referring = _ids_where(database, relationship.collection, relationship.field, values, size)
+            added = select(relationship.collection, referring)
+            if len(added):
+                pending.append((relationship.collection, added))
+
+    add_referenced_ids(database, relationships, selected, size)
+
+    for name, ids in selected.items():
+        echo("{:40} {} related documents".format(name, len(ids)))
+    return selected
+
+
+def add_referenced_ids(database, relationships, selected, size=DEFAULT_IN_BATCH_SIZE):
+    """Adds to selected, {collection name: IdSet}, whatever the selected documents refer to, transitively
+
+    So a subset holds no dangling references.
+    """
+    relationships = [parse_relationship(relationship) for relationship in relationships]
+
+    def select(name, ids):
+        return selected.setdefault(name, IdSet()).update(ids)
+
+    pending = list(selected.items())
+    while pending:
+        name, ids = pending.pop(0)
+        for relationship in relationships:
+            if relationship.collection != name or not len(ids):
+                continue
+            values = _values_of(database, name, ids, relationship.field, size)
+            referred = _ids_where(database, relationship.target, relationship.target_field, values, size)
+            added = select(relationship.target, referred)
+            if len(added):
+                pending.append((relationship.target, added))
+    return selected
@@ -0,0 +1,81 @@
+"""
+What a migration run cost
+
+Migration._run measures each run with a RunTelemetry and hands the figures to record_run, MongoBackedMigration keeps
+them on its MongoMigrationHistory record where list_migrations shows them.  CPU time and peak RSS are those of the
+whole monarch process, so when migrations run side by side (migrate --workers) they include the others' share.
+"""
+import sys
+import time
+import threading
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+TELEMETRY_FIELDS = ('started_at', 'processed_at', 'wall_seconds', 'cpu_seconds', 'peak_rss_bytes',
+                    'documents_read', 'documents_written')
+
+
+def cpu_seconds():
+    """user + system CPU time of the process so far"""
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+    return time.process_time() if hasattr(time, 'process_time') else time.clock()
+
+
+def peak_rss_bytes():
+    """the most memory the process has held at once, None where the platform does not tell"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RunTelemetry(object):
+    """Times one run and counts the documents it reads and writes, count() is safe to call from worker threads"""
+
+    def __init__(self):
+        self.started_at = None
+        self.documents_read = 0
+        self.documents_written = 0
+        self._started = None
+        self._cpu_started = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.started_at = datetime.utcnow()
+        self._started = time.time()
+        self._cpu_started = cpu_seconds()
+        return self
+
+    def count(self, read=0, written=0):
+        with self._lock:
+            self.documents_read += read
+            self.documents_written += written
+
+    def finish(self):
+        """the figures of the run so far, keyed like TELEMETRY_FIELDS"""
+        return {
+            'started_at': self.started_at,
+            'processed_at': datetime.utcnow(),
+            'wall_seconds': time.time() - self._started,
+            'cpu_seconds': cpu_seconds() - self._cpu_started,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'documents_read': self.documents_read,
+            'documents_written': self.documents_written,
+        }
+
+
+def telemetry_of(record):
+    """the TELEMETRY_FIELDS of a history record as plain json, dates in iso format"""
+    telemetry = {}
+    for field in TELEMETRY_FIELDS:
+        value = getattr(record, field, None)
+        telemetry[field] = value.isoformat() if isinstance(value, datetime) else value
+    return telemetry
@@ -16,10 +16,23 @@ from monarch import {base_class}
 # Note: Using echos (or prints) will mess up the way this looks
 #
 # More info: http://click.pocoo.org/utils/#showing-progress-bars
+#
+# To change many documents, let monarch batch the reads and writes (with its own progressbar):
+#
+# from pymongo import UpdateOne
+#
+# def run(self):
+#     self.process_in_batches('users', lambda user: UpdateOne({{'_id': user['_id']}},
+#                                                             {{'$set': {{'email': user['email'].lower()}}}}),
+#                             query={{'email': {{'$exists': True}}}}, batch_size=1000, workers=4)
 
 
 class {migration_class_name}({base_class}):
 
+    # Optionally, so `monarch migrate --workers` can run this alongside migrations it shares no collection with
+    # collections = ['users']
+    # depends_on = ['AddIndexesMigration']
+
     def run(self):
         """Write the code here that will migrate the database from one state to the next
             No Need to handle exceptions -- we will take care of that for you
@@ -36,6 +49,9 @@ from monarch import {base_class}
 
 class {queryset_class_name}({base_class}):
 
+    # foreign keys self.dump_related('dogs', {{'type': 'Awesome'}}) follows to bring related documents along
+    # relationships = ['dog_houses.dog_id -> dogs._id']
+
     def run(self):
         """Write the code here that will perform the mongo dump of the collections that you care about
         """
@@ -54,13 +70,44 @@ ENVIRONMENTS = {
         'db_name': 'your-db-name',
         'username': 'asdf',
         'password': 'asdfdf',
-        'sslCAFile': '/path/to/production.pem'
+        'sslCAFile': '/path/to/production.pem',
+        # optional settings, shown with example values -- uncomment the ones you need
+        # how many collections are dumped at once (1 by default)
+        # 'dump_concurrency': 4,
+        # 'mongodump' (default) or 'native' to dump over pymongo without the mongo tools
+        # 'dump_engine': 'native',
+        # 'direct' (default) dumps each collection of a query set with its filter, 'staged' filters on the server
+        # into a temporary database ($merge, MongoDB 4.2+) and dumps that in one pass
+        # 'query_set_mode': 'staged',
+        # foreign keys `--sample --keep-references` follows so sampled documents keep what they refer to
+        # 'relationships': ['dog_houses.dog_id -> dogs._id'],
+        # what `monarch backup --incremental` compares against the last backup, _id unless set here -- index them,
+        # setting it makes every backup record watermarks
+        # 'watermark_fields': {'accounts': 'updated_at', '*': '_id'},
+        # pause migration batches and native dumps/restores while the servers are struggling
+        # 'throttle': {
+        #     'max_replication_lag': 10,  # seconds
+        #     'max_latency_ms': 50,  # average read/write latency
+        # },
+        # the pooled connection every command shares
+        # 'pool_size': 50,  # 100 by default
+        # 'server_selection_timeout_ms': 30000,
+        # where dumps read from, e.g. 'secondaryPreferred' -- migrations always read from the primary
+        # 'read_preference': 'primary',
+        # wire compression, the first one the server also supports is used (zstd needs zstandard, snappy python-snappy)
+        # 'compressors': ['zstd', 'snappy', 'zlib'],
     },
     'development': {
         'host': 'your-host:12345',
         'db_name': 'your-db-name',
         'username': 'asdf',
-        'password': 'asdfdf'
+        'password': 'asdfdf',
+        # 'mongorestore' (default) or 'native' to load with parallel insert_many batches over pymongo
+        # 'restore_engine': 'native',
+        # 'restore_workers': 4,
+        # 'replace' (default) drops the database before restoring, 'swap' restores beside the live collections and
+        # renames them into place at the end, so the environment stays up while it runs
+        # 'restore_mode': 'swap',
     },
 }
 
@@ -82,5 +129,19 @@ ENVIRONMENTS = {
 #     }
 # }
 
+# Either section also takes
+#         'compression': 'deflate',  # none, deflate, bz2, lzma or zstd (needs the zstandard package)
+#         'compression_level': 6,
+#         'compression_workers': 4,  # how many collection files are (de)compressed at once
+#         'storage': 'archive',  # or 'chunked' to only store what changed since earlier backups
+#         'chunk_size': 8 * 1024 * 1024,  # for chunked storage
+
+# and S3 backups are sent as multipart uploads, tune them with
+#         'multipart_part_size': 64 * 1024 * 1024,
+#         'multipart_concurrency': 4,  # parts in flight at once
+# and restored with concurrent ranged downloads, tune them with
+#         'download_block_size': 16 * 1024 * 1024,
+#         'download_concurrency': 4,  # blocks fetched at once
+
 
 """
\ No newline at end of file
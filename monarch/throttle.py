@@ -0,0 +1,199 @@
+"""
+Load aware throttling
+
+Batch loops -- process_in_batches in migrations, native dumps and native restores -- call Throttle.wait() before each
+batch.  Every `check_interval` seconds it measures replication lag (replSetGetStatus) and the average latency of
+reads and writes since the last check (serverStatus opLatencies).  While either is over its limit the loop pauses,
+for longer each time the server is still behind, and the pause shrinks again once it has caught up.
+
+Set it up per environment in ENVIRONMENTS:
+
+    'throttle': {
+        'max_replication_lag': 10,  # seconds a secondary may fall behind the primary
+        'max_latency_ms': 50,  # average read/write latency on the server
+        'check_interval': 1,  # seconds between measurements
+        'max_pause': 30,  # longest single pause
+    }
+
+Leave out a limit to not watch that measure.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+from click import echo
+from pymongo.errors import OperationFailure
+
+DEFAULT_CHECK_INTERVAL = 1.0
+DEFAULT_MAX_PAUSE = 30.0
+MIN_PAUSE = 0.1
+# the code replSetGetStatus fails with on a server that is not part of a replica set
+NO_REPLICATION_ENABLED = 76
+
+
+def replication_lag(client):
+    """seconds the furthest behind secondary trails the primary, None if this is not a replica set
+
+    Raises OperationFailure if the user may not run replSetGetStatus (it needs the clusterMonitor role).
+    """
+    try:
+        status = client.admin.command('replSetGetStatus')
+    except OperationFailure as e:
+        if e.code == NO_REPLICATION_ENABLED:
+            return None
+        raise
+
+    primary = [member['optimeDate'] for member in status['members'] if member.get('stateStr') == 'PRIMARY']
+    secondaries = [member['optimeDate'] for member in status['members'] if member.get('stateStr') == 'SECONDARY']
+    if not primary or not secondaries:
+        return None
+    return max(0.0, (primary[0] - min(secondaries)).total_seconds())
+
+
+def _optime(member):
+    # {'ts': Timestamp, 't': term} with replication protocol 1, a bare Timestamp before it
+    optime = member['optime']
+    return optime['ts'] if isinstance(optime, dict) else optime
+
+
+def wait_for_secondaries(client, timeout=60, interval=0.5):
+    """Waits until every secondary has applied what the primary had written when called
+
+    True once they have, or if this is not a replica set.  False if they do not catch up within timeout seconds, or
+    if it can not be told (replSetGetStatus needs the clusterMonitor role).
+    """
+    deadline = time.time() + timeout
+    target = None
+    while True:
+        try:
+            status = client.admin.command('replSetGetStatus')
+        except OperationFailure as e:
+            return e.code == NO_REPLICATION_ENABLED
+
+        primary = [_optime(member) for member in status['members'] if member.get('stateStr') == 'PRIMARY']
+        secondaries = [_optime(member) for member in status['members'] if member.get('stateStr') == 'SECONDARY']
+        if not primary:
+            return False
+        if target is None:
+            target = primary[0]
+        if all(optime >= target for optime in secondaries):
+            return True
+        if time.time() > deadline:
+            return False
+        time.sleep(interval)
+
+
+def op_latencies(client):
+    """(total latency in microseconds, number of ops) of reads and writes since the server started, None if the user
+    may not run serverStatus (it needs the clusterMonitor role)"""
+    try:
+        status = client.admin.command('serverStatus', opLatencies={'histograms': False})
+    except OperationFailure:
+        return None
+
+    latencies = status.get('opLatencies', {})
+    latency = sum(latencies.get(kind, {}).get('latency', 0) for kind in ('reads', 'writes'))
+    ops = sum(latencies.get(kind, {}).get('ops', 0) for kind in ('reads', 'writes'))
+    return latency, ops
+
+
+class Throttle(object):
+    """Paces a batch loop to keep the server under the configured limits, shared safely between threads"""
+
+    def __init__(self, client, max_replication_lag=None, max_latency_ms=None,
+                 check_interval=DEFAULT_CHECK_INTERVAL, max_pause=DEFAULT_MAX_PAUSE, label=None):
+        self.client = client
+        self.max_replication_lag = max_replication_lag
+        self.max_latency_ms = max_latency_ms
+        self.check_interval = check_interval
+        self.max_pause = max_pause
+        self.label = label
+
+        # reason: (number of pauses, seconds paused)
+        self.pauses = OrderedDict()
+        self._pause = 0.0
+        self._last_check = None
+        self._last_latencies = None
+        self._lock = threading.Lock()
+
+    def over_limits(self):
+        """(what, details) of the limit the server is over, or None when it is within all of them"""
+        if self.max_replication_lag is not None:
+            try:
+                lag = replication_lag(self.client)
+            except OperationFailure as e:
+                # most likely the user lacks clusterMonitor, the limit can not be kept so say it is off
+                echo("{}can not read replication lag ({}), running WITHOUT max_replication_lag".format(
+                    self._prefix(), e))
+                self.max_replication_lag = None
+            else:
+                if lag is None:
+                    # not a replica set, nothing to watch
+                    self.max_replication_lag = None
+                elif lag > self.max_replication_lag:
+                    return 'replication lag', '{:.1f}s > {}s'.format(lag, self.max_replication_lag)
+
+        if self.max_latency_ms is not None:
+            latencies = op_latencies(self.client)
+            if latencies is None:
+                echo("{}can not read op latencies (serverStatus needs the clusterMonitor role), "
+                     "running without max_latency_ms".format(self._prefix()))
+                self.max_latency_ms = None
+                return None
+            previous, self._last_latencies = self._last_latencies, latencies
+            if previous is not None and latencies[1] > previous[1]:
+                average_ms = (latencies[0] - previous[0]) / 1000.0 / (latencies[1] - previous[1])
+                if average_ms > self.max_latency_ms:
+                    return 'op latency', '{:.1f}ms > {}ms'.format(average_ms, self.max_latency_ms)
+
+        return None
+
+    def wait(self):
+        """call before each batch, returns the seconds spent waiting"""
+        with self._lock:
+            now = time.time()
+            if self._last_check is not None and now - self._last_check < self.check_interval:
+                return 0.0
+
+            waited = 0.0
+            while True:
+                self._last_check = time.time()
+                over = self.over_limits()
+                if over is None:
+                    # caught up, ease back towards full speed
+                    self._pause = self._pause / 2 if self._pause > MIN_PAUSE else 0.0
+                    return waited
+
+                self._pause = min(self.max_pause, max(MIN_PAUSE, self._pause * 2))
+                reason, details = over
+                time.sleep(self._pause)
+                waited += self._pause
+                count, seconds = self.pauses.get(reason, (0, 0.0))
+                self.pauses[reason] = (count + 1, seconds + self._pause)
+                echo("{}paused {:.1f}s, {} {}".format(self._prefix(), self._pause, reason, details))
+
+    def _prefix(self):
+        return '{}: '.format(self.label) if self.label else ''
+
+    def report(self):
+        """tells how long the throttle paused and why, if it did"""
+        if not self.pauses:
+            return
+        echo("{}throttled for {:.1f}s in total: {}".format(
+            self._prefix(),
+            sum(seconds for _, seconds in self.pauses.values()),
+            ", ".join("{} pauses for {} ({:.1f}s)".format(count, reason, seconds)
+                      for reason, (count, seconds) in self.pauses.items())))
+
+
+def throttle_for(environment, client, label=None):
+    """a Throttle set up from the environment's 'throttle' settings, or None if it has none"""
+    settings = environment.get('throttle')
+    if not settings:
+        return None
+    return Throttle(client,
+                    max_replication_lag=settings.get('max_replication_lag'),
+                    max_latency_ms=settings.get('max_latency_ms'),
+                    check_interval=settings.get('check_interval', DEFAULT_CHECK_INTERVAL),
+                    max_pause=settings.get('max_pause', DEFAULT_MAX_PAUSE),
+                    label=label)
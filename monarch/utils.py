@@ -1,15 +1,46 @@
 import os
+import sys
+import bz2
+import time
+import zlib
+import gzip
 import zipfile
 import re
 import shutil
+import threading
 from tempfile import mkdtemp
+from collections import deque
 from contextlib import contextmanager
 
+from six.moves import queue
+
 from click import echo
 
+try:
+    import lzma
+except ImportError:  # python 2
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 CAMEL_PAT = re.compile(r'([A-Z])')
 UNDER_PAT = re.compile(r'_([a-z])')
 
+# codec name: (file suffix, default level)
+COMPRESSION_CODECS = {
+    'none': ('', None),
+    'deflate': ('.gz', 6),
+    'bz2': ('.bz2', 9),
+    'lzma': ('.xz', 6),
+    'zstd': ('.zst', 3),
+}
+DEFAULT_COMPRESSION = 'deflate'
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
 
 @contextmanager
 def temp_directory():
@@ -33,18 +64,274 @@ def sizeof_fmt(num):
         num /= 1024.0
 
 
-def zipdir(dump_path):
-    def _zipdir(path, zip):
+def available_codecs():
+    codecs = ['none', 'deflate', 'bz2']
+    if lzma is not None:
+        codecs.append('lzma')
+    if zstandard is not None:
+        codecs.append('zstd')
+    return codecs
+
+
+def compression_options(backup_settings):
+    """reads compression, compression_level and compression_workers from a BACKUPS section"""
+    codec = backup_settings.get('compression', DEFAULT_COMPRESSION)
+    if codec not in available_codecs():
+        exit_with_message('compression [{}] is not available, choose one of {}'.format(
+            codec, ", ".join(available_codecs())))
+
+    return {
+        'codec': codec,
+        'level': backup_settings.get('compression_level'),
+        'workers': backup_settings.get('compression_workers', 1),
+    }
+
+
+def codec_of(file_name):
+    """the codec a file was compressed with, judging by its suffix"""
+    for codec, (suffix, _) in COMPRESSION_CODECS.items():
+        if suffix and file_name.endswith(suffix):
+            return codec
+    return 'none'
+
+
+def strip_codec_suffix(file_name):
+    suffix = COMPRESSION_CODECS[codec_of(file_name)][0]
+    return file_name[:-len(suffix)] if suffix else file_name
+
+
+def open_compressed(path, codec, level=None):
+    """opens path for writing through the codec's compressor"""
+    if level is None:
+        level = COMPRESSION_CODECS[codec][1]
+
+    if codec == 'deflate':
+        return gzip.open(path, 'wb', compresslevel=level)
+    elif codec == 'bz2':
+        return bz2.BZ2File(path, 'wb', compresslevel=level)
+    elif codec == 'lzma':
+        return lzma.open(path, 'wb', preset=level)
+    elif codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).stream_writer(open(path, 'wb'))
+    else:
+        return open(path, 'wb')
+
+
+def decompressing_reader(fileobj, codec):
+    """wraps a readable binary file object so reads come back decompressed"""
+    if codec == 'deflate':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif codec == 'bz2':
+        return bz2.BZ2File(fileobj, 'rb')
+    elif codec == 'lzma':
+        return lzma.LZMAFile(fileobj, 'rb')
+    elif codec == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    else:
+        return fileobj
+
+
+def compress_bytes(data, codec, level=None):
+    """compresses data in memory, the result reads back the same as a file written by open_compressed"""
+    if level is None:
+        level = COMPRESSION_CODECS[codec][1]
+
+    if codec == 'deflate':
+        # wbits 31 writes a gzip header, like gzip.open
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    elif codec == 'bz2':
+        return bz2.compress(data, level)
+    elif codec == 'lzma':
+        return lzma.compress(data, preset=level)
+    elif codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    else:
+        return data
+
+
+def decompress_bytes(data, codec):
+    if codec == 'deflate':
+        return zlib.decompress(data, 31)
+    elif codec == 'bz2':
+        return bz2.decompress(data)
+    elif codec == 'lzma':
+        return lzma.decompress(data)
+    elif codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    else:
+        return data
+
+
+def compress_file(source_path, target_dir, codec, level=None):
+    """compresses source_path into target_dir, returns the path of the compressed file"""
+    target_path = os.path.join(target_dir, os.path.basename(source_path) + COMPRESSION_CODECS[codec][0])
+    with open(source_path, 'rb') as source:
+        with open_compressed(target_path, codec, level) as target:
+            shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+    return target_path
+
+
+def compressor(codec, level=None):
+    """an incremental compressor -- compress(data), then flush() -- writing what open_compressed writes"""
+    if level is None:
+        level = COMPRESSION_CODECS[codec][1]
+
+    if codec == 'deflate':
+        # wbits 31 writes a gzip header, like gzip.open
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    elif codec == 'bz2':
+        return bz2.BZ2Compressor(level)
+    elif codec == 'lzma':
+        return lzma.LZMACompressor(preset=level)
+    elif codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    else:
+        return _Uncompressed()
+
+
+class _Uncompressed(object):
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+# compressed buffers a file may be ahead of the zip by, per worker
+QUEUED_PIECES = 4
+
+
+def _compress_pieces(path, codec, level, pieces, stopped):
+    """compresses path a buffer at a time onto the queue pieces, then puts None"""
+    def put(piece):
+        while not stopped.is_set():
+            try:
+                pieces.put(piece, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise Exception("archiving was stopped")
+
+    try:
+        compressing = compressor(codec, level)
+        with open(path, 'rb') as source:
+            for block in iter(lambda: source.read(COPY_BUFFER_SIZE), b''):
+                piece = compressing.compress(block)
+                if piece:
+                    put(piece)
+        put(compressing.flush())
+    finally:
+        if not stopped.is_set():
+            put(None)
+
+
+def zipdir(dump_path, codec='none', level=None, workers=1, target='MongoDump.zip'):
+    """Archives the dump into target, a file name or a writable file object
+
+    Each collection file is compressed with codec on its own and streamed straight into the zip, stored as it is --
+    nothing is written to disk but target.  `workers` files are compressed at a time, the ones behind the file
+    being written wait with a few buffers ready.  Restores tell the codec apart by the member suffixes.
+    """
+    def _dump_files(path):
         for root, dirs, files in os.walk(path):
             for file in files:
-                zip.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), root))
+                yield os.path.join(root, file)
+
+    if sys.version_info < (3, 6):
+        # zip members can only be written from files before 3.6
+        return _zipdir_through_files(list(_dump_files(dump_path)), codec, level, workers, target)
+
+    zipf = zipfile.ZipFile(target, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    stopped = threading.Event()
 
-    zipf = zipfile.ZipFile('MongoDump.zip', 'w')
-    _zipdir(dump_path, zipf)
+    def write_member(path, pieces, result):
+        member = zipfile.ZipInfo(os.path.basename(path) + COMPRESSION_CODECS[codec][0],
+                                 date_time=time.localtime(os.path.getmtime(path))[:6])
+        # the size is not known up front, members that could pass 2GB need the zip64 fields from the start
+        with zipf.open(member, 'w', force_zip64=os.path.getsize(path) * 1.1 > zipfile.ZIP64_LIMIT) as f:
+            for piece in iter(pieces.get, None):
+                f.write(piece)
+        result.get()
+
+    with WorkerPool(workers) as pool:
+        try:
+            pending = deque()
+            for path in _dump_files(dump_path):
+                pieces = queue.Queue(QUEUED_PIECES)
+                pending.append((path, pieces, pool.submit(_compress_pieces, path, codec, level, pieces, stopped)))
+                if len(pending) >= pool.workers:
+                    write_member(*pending.popleft())
+            while pending:
+                write_member(*pending.popleft())
+        except Exception:
+            # the workers still compressing give up instead of waiting on a zip nobody writes anymore
+            stopped.set()
+            raise
+        pool.join()
     zipf.close()
+
     return zipf
 
 
+def _zipdir_through_files(members, codec, level, workers, target):
+    with temp_directory() as compressed_dir:
+        if codec != 'none':
+            with WorkerPool(workers) as pool:
+                for path in members:
+                    pool.submit(compress_file, path, compressed_dir, codec, level)
+                members = pool.join()
+
+        zipf = zipfile.ZipFile(target, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        for member in members:
+            zipf.write(member, os.path.basename(member))
+        zipf.close()
+
+    return zipf
+
+
+class WorkerPool(object):
+    """A thread pool that blocks the submitter once `workers` tasks are in flight"""
+
+    def __init__(self, workers):
+        # multiprocessing takes a while to import, leave it out of CLI startup
+        from multiprocessing.pool import ThreadPool
+
+        self.workers = max(1, int(workers))
+        self._pool = ThreadPool(self.workers)
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._results = []
+
+    def submit(self, func, *args, **kwargs):
+        self._slots.acquire()
+
+        def task():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._slots.release()
+
+        result = self._pool.apply_async(task)
+        self._results.append(result)
+        return result
+
+    def join(self):
+        """waits for every submitted task and returns their results in submission order,
+        re-raising the first failure once everything has finished"""
+        self._pool.close()
+        self._pool.join()
+        return [result.get() for result in self._results]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._pool.terminate()
+        self._pool.join()
+
+
 def exit_with_message(message):
     echo()
     echo(message)
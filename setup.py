@@ -22,7 +22,8 @@ setup(
     install_requires=[
         'Click>2.0',
         'jinja2',
-        'mongoengine',
+        'mongoengine>=0.20',
+        'pymongo>=3.7',
         'boto',
     ],
     tests_require=['nose'],